@@ -1,11 +1,75 @@
-from fabric.api import local, cd
+from fabric.api import local, cd, settings, hide
 import os
+import time
+
+from pantheon import gittools
+from pantheon import logger
+from pantheon import pantheon
 
 CHRONOS = "https://code.getpantheon.com/sites/self/code"
 
-def sync_repo():
+# Ref tips and timings of the last sync, stored in the state directory.
+SYNC_STATE = "pantheon_chronos.json"
+
+def sync_repo(remote=CHRONOS):
+    """Push new branch history to remote and fetch remote's HEAD.
+    remote: url (or path) of the remote repository.
+
+    The remote's refs are read with a single ls-remote. Only branches whose
+    tip differs from the remote are pushed, and remote's HEAD is only fetched
+    when its commit is missing locally, so an unchanged repository costs one
+    round trip. Tips and timings are recorded in SYNC_STATE.
+
+    """
+    log = logger.logging.getLogger('pantheon.chronos.sync_repo')
     os.environ["GIT_SSL_CERT"] = "/etc/pantheon/system.pem"
     project_directory = os.listdir("/var/git/projects/")[0]
-    with cd("/var/git/projects/%s" % project_directory):
-        local("git push --all %s" % CHRONOS, capture=False)
-        local("git fetch %s" % CHRONOS, capture=False)
+    git_dir = "/var/git/projects/%s" % project_directory
+    state_file = os.path.join(pantheon.get_state_dir(project_directory),
+                              SYNC_STATE)
+    state = pantheon.load_json(state_file) or dict()
+    if state.get('remote') != remote:
+        state = {'remote': remote}
+    timings = dict()
+    start = time.time()
+
+    with cd(git_dir):
+        with settings(hide('running', 'stdout')):
+            advertised = local("git ls-remote %s" % remote)
+        timings['ls-remote'] = time.time() - start
+        remote_refs = dict()
+        for line in advertised.splitlines():
+            sha, ref = line.split('\t', 1)
+            remote_refs[ref] = sha
+
+        local_refs = gittools.get_refs(git_dir)
+        push = sorted([ref for ref, sha in local_refs.items() \
+                       if remote_refs.get(ref) != sha])
+        if push:
+            mark = time.time()
+            local("git push %s %s" % (remote, ' '.join(['%s:%s' % (ref, ref) \
+                                                        for ref in push])),
+                  capture=False)
+            timings['push'] = time.time() - mark
+
+        # Tips recorded last time are known to be present locally.
+        head = remote_refs.get('HEAD')
+        if head and head != state.get('remote_refs', dict()).get('HEAD'):
+            with settings(hide('everything'), warn_only=True):
+                missing = local("git cat-file -e %s" % head).failed
+            if missing:
+                mark = time.time()
+                local("git fetch %s" % remote, capture=False)
+                timings['fetch'] = time.time() - mark
+
+    for ref in push:
+        remote_refs[ref] = local_refs[ref]
+    timings['total'] = time.time() - start
+    state.update({'local_refs': local_refs,
+                  'remote_refs': remote_refs,
+                  'synced': int(start),
+                  'timings': timings})
+    pantheon.save_json(state_file, state)
+    log.info('Synced %s with %s: pushed %s branches, %sfetched (%.2fs).' % (
+             project_directory, remote, len(push),
+             '' if 'fetch' in timings else 'not ', timings['total']))
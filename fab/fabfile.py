@@ -11,6 +11,7 @@ from site_devel import *
 from site_onramp import *
 from site_install import *
 from usage import *
+from maintenance import *
 from update import *
 from chronos import *
 env.hosts = ['pantheon@localhost']
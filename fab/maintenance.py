@@ -0,0 +1,64 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import os
+import time
+
+from pantheon import gittools
+from pantheon import logger
+from pantheon import pantheon
+
+from fabric.api import *
+
+# Don't start maintaining another repository above this 1 minute load average.
+MAX_LOAD = 2.0
+
+# Don't start maintaining another repository after this many seconds.
+TIME_BUDGET = 1800
+
+def maintain_repositories(max_load=MAX_LOAD, budget=TIME_BUDGET):
+    """Repack, write commit-graphs and prune the project git repositories.
+    max_load: float. Stop once the 1 minute load average exceeds this.
+    budget: int. Stop starting new repositories after this many seconds.
+
+    Covers the central repositories in /var/git/projects and the working-trees
+    of each environment. Git runs at the lowest CPU and I/O priority. Central
+    repositories are never pruned, as the environments borrow their objects.
+
+    """
+    log = logger.logging.getLogger('pantheon.maintenance.repositories')
+    max_load = float(max_load)
+    deadline = time.time() + int(budget)
+    nice = _get_nice()
+    webroot = pantheon.PantheonServer().webroot
+
+    repos = list()
+    for project in sorted(os.listdir('/var/git/projects')):
+        repos.append((os.path.join('/var/git/projects', project), True))
+        for env in sorted(pantheon.get_environments()):
+            git_dir = os.path.join(webroot, project, env, '.git')
+            if os.path.isdir(git_dir):
+                repos.append((os.path.realpath(git_dir), False))
+
+    maintained = 0
+    for git_dir, shared in repos:
+        load = os.getloadavg()[0]
+        if load > max_load:
+            log.warning('Stopping repository maintenance: load average ' \
+                        '%.2f exceeds %.2f.' % (load, max_load))
+            break
+        if time.time() > deadline:
+            log.warning('Stopping repository maintenance: time budget of ' \
+                        '%s seconds used.' % budget)
+            break
+        gittools.maintain_repo(git_dir, shared, nice)
+        maintained += 1
+    log.info('Maintained %s of %s repositories.' % (maintained, len(repos)))
+
+def _get_nice():
+    """Return the command prefix that runs a command at idle priority.
+
+    """
+    nice = 'nice -n 19'
+    with settings(hide('everything'), warn_only=True):
+        if not local('which ionice').failed:
+            nice += ' ionice -c 3'
+    return nice
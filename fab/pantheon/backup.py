@@ -10,6 +10,7 @@ import tempfile
 from configobj import ConfigObj
 from fabric.api import *
 
+import filetools
 import pantheon
 import logger
 import ygg
@@ -64,9 +65,11 @@ class PantheonBackup():
             source = os.path.join(self.server.webroot, self.project, 'dev')
             destination = 'code'
             with cd(self.backup_dir):
-                local('git clone %s -b %s %s' % (source,
-                                                 self.project,
-                                                 destination))
+                # A file:// url forces a full copy of the objects, so the
+                # clone does not depend on the server's shared object store.
+                local('git clone file://%s -b %s %s' % (source,
+                                                        self.project,
+                                                        destination))
                 # Manually set origin URL so remote pushes have a destination.
                 with cd(destination):
                     local("sed -i 's/^.*url =.*$/\\turl = " + \
@@ -95,7 +98,7 @@ class PantheonBackup():
                                            'dev_code/sites/default')):
                 destination = os.path.join(self.backup_dir,
                                            'dev_code/sites/default')
-            local('rsync -avz %s %s' % (source, destination))
+            filetools.transfer(source, os.path.join(destination, 'files'))
         except:
             self.log.exception('Archival of files was unsuccessful.')
             raise
@@ -182,7 +185,14 @@ class PantheonBackup():
             local('mkdir -p %s' % self.backup_dir)
             for env in self.environments:
                 source = os.path.join(self.server.webroot, self.project, env)
-                local('rsync -avz %s %s' % (source, self.backup_dir))
+                destination = os.path.join(self.backup_dir, env)
+                filetools.transfer(source, destination)
+                # Release environments link to a shared files directory.
+                files = os.path.join(destination, 'sites/default/files')
+                if os.path.islink(files):
+                    os.remove(files)
+                    filetools.transfer(os.path.realpath(os.path.join(source,
+                                                'sites/default/files')), files)
         except:
             self.log.exception('Backing up the files was unsuccessful.')
             raise
@@ -213,7 +223,7 @@ class PantheonBackup():
         self.log.info('Initialized backup of repo.')
         try:
             dest = os.path.join(self.backup_dir, '%s.git' % (self.project))
-            local('rsync -avz /var/git/projects/%s/ %s' % (self.project, dest))
+            filetools.transfer('/var/git/projects/%s' % self.project, dest)
         except:
             self.log.exception('Backing up the repo was unsuccessful.')
             raise
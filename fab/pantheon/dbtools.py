@@ -1,8 +1,12 @@
 import MySQLdb
 import os
+import logger
 import pantheon
 from fabric.api import local
 
+# Open MySQLConn objects, keyed by connection parameters.
+_connections = dict()
+
 def export_data(self, environment, destination):
     """Export the database for a particular project/environment to destination.
 
@@ -29,6 +33,87 @@ def import_data(self, environment, source):
     create_database(db_name)
     import_db_dump(source, db_name)
 
+def get_connection(username='root', password='', database=None, cursor=None):
+    """Return a pooled MySQLConn, opening a new connection if needed.
+    Connections are shared between callers using the same parameters, so
+    callers should not close them. Use close_connections() when finished.
+
+    """
+    key = (username, password, database, cursor)
+    db = _connections.get(key)
+    if (db is None) or (not db.connection.open):
+        db = MySQLConn(username, password, database, cursor)
+        _connections[key] = db
+    return db
+
+def close_connections():
+    """Close all pooled connections.
+
+    """
+    for db in _connections.values():
+        if db.connection.open:
+            db.close()
+    _connections.clear()
+
+def get_installed_databases(databases):
+    """Return the subset of databases that contain a Drupal system table.
+    databases: list of database names to check.
+    returns: set of database names.
+
+    All databases are checked with a single information_schema query over the
+    pooled root connection. As with the former 'show tables | awk /system/'
+    check, any table name containing 'system' counts (table prefixes).
+
+    """
+    databases = list(databases)
+    if not databases:
+        return set()
+    db = get_connection()
+    rows = db.execute("SELECT DISTINCT TABLE_SCHEMA " + \
+                      "FROM information_schema.TABLES " + \
+                      "WHERE TABLE_NAME LIKE '%%system%%' " + \
+                      "AND TABLE_SCHEMA IN (%s)" % \
+                                ', '.join(['%s'] * len(databases)),
+                      args=databases)
+    return set([row[0] for row in rows])
+
+def rewrite_file_paths(db, old_path, new_path, version, batch_size=5000):
+    """Replace old_path with new_path for all files in the Drupal files table.
+    db: MySQLConn connected to the Drupal database.
+    old_path: path to replace (e.g. sites/example.com/files).
+    new_path: replacement path (e.g. sites/default/files).
+    version: int. Major Drupal version (6: files.filepath, 7: file_managed.uri)
+    batch_size: number of primary keys to update per transaction.
+    returns: number of rows changed.
+
+    Rows are updated in ranges of fid, committing after each range, so large
+    tables are never locked by a single long-running transaction.
+
+    """
+    log = logger.logging.getLogger('pantheon.dbtools.rewrite_file_paths')
+    if version == 6:
+        table, column = ('files', 'filepath')
+    else:
+        table, column = ('file_managed', 'uri')
+
+    (first, last) = db.execute('SELECT MIN(fid), MAX(fid) FROM %s' % table,
+                               fetchall=False)
+    if first is None:
+        log.info('No files found in %s.' % table)
+        return 0
+
+    changed = 0
+    query = "UPDATE {0} SET {1} = REPLACE({1}, %s, %s) " \
+            "WHERE fid BETWEEN %s AND %s AND {1} LIKE %s".format(table, column)
+    for start in xrange(first, last + 1, batch_size):
+        end = min(start + batch_size - 1, last)
+        db.execute(query, fetchall=False, args=(old_path, new_path, start, end,
+                                                '%%%s%%' % old_path))
+        changed += db.cursor.rowcount
+        log.info('Updated file paths for fid %s-%s of %s (%s changed).' % (
+                                                 start, end, last, changed))
+    return changed
+
 def create_database(database):
     """Drop database if it already exists, then create a new empty db.
 
@@ -103,13 +188,14 @@ class MySQLConn(object):
         self.connection = self._mysql_connect(database, username, password)
         self.cursor = self.connection.cursor(cursor)
 
-    def execute(self, query, fetchall=True, warn_only=False):
+    def execute(self, query, fetchall=True, warn_only=False, args=None):
         """Execute a command on the connection.
         query: SQL statement.
+        args: optional sequence of values to escape into query placeholders.
 
         """
         try:
-            self.cursor.execute(query)
+            self.cursor.execute(query, args)
             self.connection.commit()
         except MySQLdb.Error, e:
             self.connection.rollback()
@@ -1,53 +1,84 @@
 import os
+import re
 import sys
-import tempfile
+import time
 
 from fabric.api import *
 import MySQLdb
 
 import pantheon
 
+# Matches the VERSION define in system.module (D6) or bootstrap.inc (D7).
+VERSION_PATTERN = re.compile(r"define\('VERSION',\s*'([67])\.([0-9]{1,2})")
+
+# Bytes read from the start of a file when looking for the VERSION define.
+READ_SIZE = 16384
+
+# Update status is cached in the state directory for this many seconds.
+STATUS_TTL = 300
+STATUS_CACHE = 'pantheon_status.json'
+
+# Parsed versions, keyed by (path, mtime, size) for files and sha for blobs.
+_VERSION_CACHE = dict()
+
 def updatedb(alias):
     with settings(warn_only=True):
         result = local('drush %s -by updb' % alias)
     return result
 
-def get_drupal_update_status(project):
+def get_drupal_update_status(project, ttl=STATUS_TTL):
     """Return dictionary of Drupal/Pressflow version/update information.
     project: Name of project.
+    ttl: seconds a stored status is reused if no environment has changed.
+
+    Upstream is fetched once, into the central repository. Each environment
+    is compared against upstream master in the central repository, which
+    already holds every deployed commit.
 
     """
     repo_path = os.path.join('/var/git/projects', project)
     project_path = os.path.join(pantheon.PantheonServer().webroot, project)
     environments = pantheon.get_environments()
-    status = dict()
+    cache_file = os.path.join(pantheon.get_state_dir(project), STATUS_CACHE)
 
+    heads = dict()
+    for env in environments:
+        with cd(os.path.join(project_path, env)):
+            with hide('running'):
+                heads[env] = local('git rev-parse refs/heads/%s' % \
+                                   project).rstrip('\n')
+
+    cached = pantheon.load_json(cache_file)
+    if cached and cached['heads'] == heads and \
+       time.time() - cached['time'] < ttl:
+        return cached['status']
+
+    status = dict()
     with cd(repo_path):
         # Get upstream updates.
         local('git fetch origin')
         # Determine latest upstream version.
         latest_drupal_version = _get_latest_drupal_version()
 
-    for env in environments:
-        env_path = os.path.join(project_path, env)
-
-        with cd(env_path):
-            local('git fetch origin')
-
+        for env in environments:
+            env_path = os.path.join(project_path, env)
             drupal_version = get_drupal_version(env_path)
 
             # python -> json -> php boolean disagreements. Just use int.
             drupal_update = int(latest_drupal_version != drupal_version)
 
-            # Determine if there have been any new commits.
-            # NOTE: Removed reporting back with log entries, so using logs
-            # to determine if there is an update is a little silly. However,
-            # we may want to send back logs someday, so leaving for now.
-            pantheon_log = local('git log refs/heads/%s' % project + \
-                                 '..refs/remotes/origin/master').rstrip('\n')
-
-            # If log is impty, no updates.
-            pantheon_update = int(bool(pantheon_log))
+            # Determine if there have been any new upstream commits.
+            with settings(hide('running', 'warnings'), warn_only=True):
+                count = local('git rev-list --count %s..refs/heads/master' % \
+                              heads[env])
+            if count.failed:
+                # Commit not in the central repository (e.g. unpushed dev
+                # commits). Fall back to checking in the environment.
+                with cd(env_path):
+                    local('git fetch origin')
+                    count = local('git rev-list --count refs/heads/%s' % \
+                                  project + '..refs/remotes/origin/master')
+            pantheon_update = int(count.strip() != '0')
 
             #TODO: remove the reference to platform once Atlas no longer uses it.
             status[env] = {'drupal_update': drupal_update,
@@ -55,6 +86,10 @@ def get_drupal_update_status(project):
                            'current': {'platform': 'DRUPAL',
                                        'drupal_version': drupal_version},
                            'available': {'drupal_version': latest_drupal_version,}}
+
+    pantheon.save_json(cache_file, {'time': time.time(),
+                                    'heads': heads,
+                                    'status': status})
     return status
 
 def get_drupal_version(drupal_root):
@@ -72,20 +107,37 @@ def get_drupal_version(drupal_root):
             break
     return version
 
+def parse_version_string(contents):
+    """Return the Drupal version (e.g. '6-22') defined in contents, or None.
+    contents: string. Contents of system.module or bootstrap.inc.
+
+    """
+    match = VERSION_PATTERN.search(contents)
+    if match:
+        return '%s-%s' % match.groups()
+    return None
+
 def _get_latest_drupal_version():
     """Check master (upstream) files to determine newest drupal version.
 
+    Must be run inside the repository, e.g. in: with cd(repo_path):
+
     """
     locations = ['modules/system/system.module',
                  'includes/bootstrap.inc']
     version = None
     for location in locations:
-        contents = local('git cat-file blob refs/heads/master:%s' % location)
-        temp_file = tempfile.mkstemp()[1]
-        with open(temp_file, 'w') as f:
-            f.write(contents)
-        version = _parse_drupal_version(temp_file)
-        local('rm -f %s' % temp_file)
+        with settings(hide('running', 'warnings'), warn_only=True):
+            blob = local('git rev-parse --verify -q ' + \
+                         'refs/heads/master:%s' % location).rstrip('\n')
+        if blob.failed or not blob:
+            continue
+        # Blobs are immutable, so their version can be cached by sha.
+        if blob not in _VERSION_CACHE:
+            with hide('running'):
+                contents = local('git cat-file blob %s' % blob)
+            _VERSION_CACHE[blob] = parse_version_string(contents)
+        version = _VERSION_CACHE[blob]
         if version:
             break
     return version
@@ -95,10 +147,17 @@ def _parse_drupal_version(location):
     location: full path to file to parse.
 
     """
-    version = local("awk \"/define\(\'VERSION\'/\" " + location + \
-                 " | sed \"s_^.*'\([6,7]\{1\}\)\.\([0-9]\{1,2\}\).*_\\1-\\2_\""
-                 ).rstrip('\n')
-    if len(version) > 1 and version[0:1] in ['6', '7']:
-        return version
-    return None
-
+    try:
+        st = os.stat(location)
+    except OSError:
+        return None
+    key = (location, st.st_mtime, st.st_size)
+    if key not in _VERSION_CACHE:
+        with open(location, 'r') as f:
+            # The define is near the top; only read further if it is not.
+            contents = f.read(READ_SIZE)
+            version = parse_version_string(contents)
+            if version is None and len(contents) == READ_SIZE:
+                version = parse_version_string(contents + f.read())
+        _VERSION_CACHE[key] = version
+    return _VERSION_CACHE[key]
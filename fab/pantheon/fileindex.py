@@ -0,0 +1,334 @@
+import cPickle
+import errno
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import Queue
+
+import filetools
+import logger
+
+# Where per-environment indexes are stored between runs.
+INDEX_DIR = '/var/lib/pantheon/fileindex'
+
+# Bump when the stored format changes. Old indexes are discarded.
+INDEX_VERSION = 1
+
+# Directory mtimes are trusted to detect added/removed entries, so unchanged
+# directories are not listed again. Every directory is relisted by a full
+# rescan at least this often (seconds).
+FULL_SCAN_INTERVAL = 86400
+
+# Positions within a file entry.
+SIZE, MTIME, INODE, HASH, TYPE = range(5)
+
+class FileIndex(object):
+    """Persistent index of all files beneath a directory.
+
+    Files are stored as: relative path -> [size, mtime, inode, hash, type]
+    where type is 'f' (regular file) or 'l' (symlink) and hash is an md5
+    hexdigest (None unless checksum is enabled) or, for symlinks, the target.
+
+    Directories are stored with their mtime and listing. On refresh, a
+    directory whose mtime has not changed is not listed again; its known
+    files are still stat'd, as files changed in place leave the directory
+    mtime untouched. Checksums are only computed for new or changed files.
+
+    """
+    def __init__(self, root, index_file, checksum=False):
+        """Load the stored index for root, if any.
+        root: full path to the directory to index.
+        index_file: full path to the file the index is stored in.
+        checksum: bool. Store an md5 of each new or changed file.
+
+        """
+        self.log = logger.logging.getLogger('pantheon.fileindex.FileIndex')
+        # Resolved, as release environments link to a shared files dir.
+        self.root = os.path.realpath(root)
+        self.index_file = index_file
+        self.checksum = checksum
+        self.dirs = dict()
+        self.files = dict()
+        self.scanned = 0
+        self._load()
+
+    def refresh(self, full=False):
+        """Bring the index up to date with the filesystem.
+        full: bool. List and stat every directory and file.
+        returns: number of directories that were (re)listed.
+
+        """
+        if time.time() - self.scanned > FULL_SCAN_INTERVAL:
+            full = True
+        start = time.time()
+        old_dirs, old_files = self.dirs, self.files
+        self.dirs, self.files = dict(), dict()
+        listed = 0
+
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            path = self.path(rel)
+            try:
+                st = os.lstat(path)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            if not stat.S_ISDIR(st.st_mode):
+                continue
+            known = old_dirs.get(rel)
+            if not full and known and known[0] == st.st_mtime:
+                subdirs = known[1]
+                names = [name for name in known[2] \
+                         if self._stat(rel, name, old_files) == 'file']
+            else:
+                subdirs, names = self._list(rel, old_files)
+                listed += 1
+            # A directory modified within the last second could change again
+            # without its mtime moving. Don't trust it on the next refresh.
+            mtime = st.st_mtime if st.st_mtime < start - 1 else None
+            self.dirs[rel] = [mtime, subdirs, names]
+            stack.extend([_join(rel, name) for name in subdirs])
+
+        if full:
+            self.scanned = start
+        self.log.debug('Refreshed index of %s: %s files, listed %s of %s ' \
+                       'directories.' % (self.root, len(self.files), listed,
+                                         len(self.dirs)))
+        return listed
+
+    def save(self):
+        """Write the index to index_file, atomically replacing the old one.
+
+        """
+        directory = os.path.dirname(self.index_file)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump({'version': INDEX_VERSION,
+                          'root': self.root,
+                          'scanned': self.scanned,
+                          'dirs': self.dirs,
+                          'files': self.files}, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp, self.index_file)
+
+    def path(self, rel):
+        """Return the full path of rel (relative to root).
+
+        """
+        return os.path.join(self.root, rel) if rel else self.root
+
+    def _list(self, rel, old_files):
+        """List directory rel and stat its entries.
+        returns: tuple of (subdirectory names, file names).
+
+        """
+        subdirs = list()
+        names = list()
+        for name in os.listdir(self.path(rel)):
+            kind = self._stat(rel, name, old_files)
+            if kind == 'dir':
+                subdirs.append(name)
+            elif kind == 'file':
+                names.append(name)
+        return (subdirs, names)
+
+    def _stat(self, rel, name, old_files):
+        """Stat entry name of directory rel and index it if it is a file.
+        returns: 'dir', 'file', or None (missing or not synced).
+
+        """
+        key = _join(rel, name)
+        path = os.path.join(self.path(rel), name)
+        try:
+            st = os.lstat(path)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        if stat.S_ISDIR(st.st_mode):
+            return 'dir'
+        if stat.S_ISREG(st.st_mode):
+            kind = 'f'
+        elif stat.S_ISLNK(st.st_mode):
+            kind = 'l'
+        else:
+            # Sockets, fifos and devices are not synced.
+            return None
+        entry = [st.st_size, st.st_mtime, st.st_ino, None, kind]
+        old = old_files.get(key)
+        if kind == 'l':
+            # Links are compared on their target, not their mtime.
+            entry[HASH] = os.readlink(path)
+        elif old and old[:HASH] == entry[:HASH] and old[TYPE] == kind:
+            entry[HASH] = old[HASH]
+        elif self.checksum:
+            entry[HASH] = _md5(path)
+        self.files[key] = entry
+        return 'file'
+
+    def _load(self):
+        """Load the stored index. A missing, stale or corrupt index is ignored.
+
+        """
+        try:
+            with open(self.index_file, 'rb') as f:
+                data = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return
+        if data.get('version') != INDEX_VERSION or \
+           data.get('root') != self.root:
+            return
+        self.scanned = data['scanned']
+        self.dirs = data['dirs']
+        self.files = data['files']
+
+
+def get_index_file(project, environment):
+    """Return the full path to the stored files index of an environment.
+
+    """
+    return os.path.join(INDEX_DIR, '%s_%s.idx' % (project, environment))
+
+def sync(source, destination, mode='copy', workers=filetools.WORKERS):
+    """Make destination an exact copy of source, based on their indexes.
+    source: FileIndex to copy from.
+    destination: FileIndex to copy into.
+    mode: 'copy' to copy file data, 'hardlink' to link files (falls back to
+          copying across filesystems).
+    workers: number of threads transferring files in parallel.
+    returns: dict with 'files', 'bytes', 'deleted' and 'changed' (list of
+             paths, relative to the roots, that were written or removed).
+
+    Both indexes are refreshed first and saved afterwards. Files are compared
+    on size, mtime and type (and hash when both sides have one), so only new
+    and changed files are transferred. Files are written to a temporary name
+    and renamed into place. Modes and mtimes are preserved; ownership is not,
+    so callers should fix permissions on the changed paths.
+
+    """
+    log = logger.logging.getLogger('pantheon.fileindex.sync')
+    source.refresh()
+    destination.refresh()
+    if mode == 'hardlink' and os.stat(source.root).st_dev != \
+                              os.stat(destination.root).st_dev:
+        mode = 'copy'
+
+    result = {'files': 0, 'bytes': 0, 'deleted': 0, 'changed': list()}
+
+    # Remove files and directories that are gone from source. Deepest first.
+    for key in sorted(destination.files, reverse=True):
+        entry = source.files.get(key)
+        if entry is None or entry[TYPE] != destination.files[key][TYPE]:
+            _remove(destination.path(key))
+            result['deleted'] += 1
+            result['changed'].append(key)
+    for key in sorted(destination.dirs, reverse=True):
+        if key and key not in source.dirs:
+            shutil.rmtree(destination.path(key), ignore_errors=True)
+            result['deleted'] += 1
+            result['changed'].append(key)
+
+    # Create missing directories, shallowest first.
+    for key in sorted(source.dirs):
+        if key and not os.path.isdir(destination.path(key)):
+            os.makedirs(destination.path(key))
+            result['changed'].append(key)
+
+    # Copy new and changed files, spread over workers.
+    pending = Queue.Queue()
+    for key, entry in source.files.iteritems():
+        current = destination.files.get(key)
+        if current is None or not _same(entry, current):
+            pending.put(key)
+            result['files'] += 1
+            result['bytes'] += entry[SIZE]
+            result['changed'].append(key)
+    errors = list()
+
+    def transfer():
+        while True:
+            try:
+                key = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                _transfer(source.path(key), destination.path(key),
+                          source.files[key], mode)
+            except Exception, e:
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=transfer) \
+               for i in range(max(1, min(workers, pending.qsize())))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    destination.refresh()
+    source.save()
+    destination.save()
+    log.info('Synced %s to %s: %s files (%s bytes) transferred, %s ' \
+             'removed.' % (source.root, destination.root, result['files'],
+                           result['bytes'], result['deleted']))
+    return result
+
+def _same(entry, other):
+    """Return True if two file entries describe the same content.
+
+    """
+    if entry[TYPE] != other[TYPE] or entry[SIZE] != other[SIZE]:
+        return False
+    if entry[HASH] and other[HASH]:
+        return entry[HASH] == other[HASH]
+    # Compare whole seconds, as copies only carry microsecond precision.
+    return int(entry[MTIME]) == int(other[MTIME])
+
+def _transfer(source, destination, entry, mode):
+    """Copy, link or recreate (symlinks) source at destination.
+
+    """
+    temp = '%s.%s.tmp' % (destination, os.getpid())
+    _remove(temp)
+    if entry[TYPE] == 'l':
+        os.symlink(os.readlink(source), temp)
+    elif mode == 'hardlink':
+        os.link(source, temp)
+    else:
+        shutil.copy2(source, temp)
+    os.rename(temp, destination)
+
+def _remove(path):
+    """Remove a file or symlink, ignoring it if it does not exist.
+
+    """
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _md5(path):
+    """Return the md5 hexdigest of the file at path.
+
+    """
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _join(rel, name):
+    """Join a relative directory and a name ('' is the root).
+
+    """
+    return '%s/%s' % (rel, name) if rel else name
@@ -0,0 +1,345 @@
+import fnmatch
+import heapq
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+# The scandir package (when installed) avoids a stat() per directory entry.
+try:
+    from scandir import walk
+except ImportError:
+    from os import walk
+
+from fabric.api import *
+
+import logger
+
+# Supported modes when populating one directory tree from another.
+#   auto:     Copy-on-write reflinks where the filesystem supports them,
+#             otherwise a full copy (parallel rsync).
+#   reflink:  Copy-on-write reflinks. Fails if the filesystem has no support.
+#   hardlink: Hardlink every file. Environments share inodes, so this is only
+#             safe where files are replaced rather than modified in place.
+#   copy:     Full copy of all data (rsync).
+COPY_MODES = ('auto', 'reflink', 'hardlink', 'copy')
+
+# Version control and OS metadata removed from imported/built codebases.
+VCS_PATTERNS = ('._*', '.git', '.bzr', '.svn', 'CVS')
+
+# Number of rsync processes run in parallel by sync_tree.
+WORKERS = 4
+
+# Bytes that weigh as much as one file when balancing sync_tree buckets.
+# Small files are dominated by per-file latency, large ones by throughput.
+BYTES_PER_FILE = 262144
+
+# Reflink support of each filesystem (by device id), probed once.
+_REFLINK_SUPPORTED = dict()
+
+def copy_tree(source, destination, mode='auto'):
+    """Copy the contents of directory source into directory destination.
+    source: full path to the directory to copy from.
+    destination: full path to the directory to copy into (created if missing).
+    mode: one of COPY_MODES. Determines how file data is copied.
+    returns: the mode that was actually used.
+
+    """
+    log = logger.logging.getLogger('pantheon.filetools.copy')
+    assert mode in COPY_MODES, 'Invalid copy mode: %s' % mode
+
+    if not os.path.exists(destination):
+        local('mkdir -p %s' % destination)
+
+    if mode == 'hardlink' and not same_filesystem(source, destination):
+        log.info('%s and %s are on different filesystems. ' \
+                 'Unable to hardlink.' % (source, destination))
+        mode = 'auto'
+    if mode == 'auto':
+        mode = 'reflink' if reflink_supported(source, destination) \
+                         else 'copy'
+
+    if mode == 'reflink':
+        local('cp -a --reflink=auto %s/. %s' % (source, destination))
+    elif mode == 'hardlink':
+        local('cp -al --remove-destination %s/. %s' % (source, destination))
+    else:
+        sync_tree(source, destination)
+    log.debug('Copied %s to %s using %s mode.' % (source, destination, mode))
+    return mode
+
+def transfer(source, destination, move=False, mode='auto'):
+    """Make destination a copy of directory source, as cheaply as possible.
+    source: path to the directory to copy. May be remote (host:path).
+    destination: path to the directory to create or update. May be remote.
+    move: bool. source is not needed afterwards and may be moved into place.
+    mode: one of COPY_MODES, used for local copies.
+    returns: how the data was transferred: 'remote', 'rename' or a copy mode.
+
+    Only transfers to or from another host go through a compressed rsync.
+    Local sources that may be moved are renamed when destination does not
+    exist yet and is on the same filesystem. Other local transfers use
+    copy_tree (reflinks, hardlinks or an uncompressed parallel sync).
+
+    """
+    log = logger.logging.getLogger('pantheon.filetools.transfer')
+    source = source.rstrip('/')
+    destination = destination.rstrip('/')
+    if is_remote(source) or is_remote(destination):
+        local('rsync -az %s/ %s/' % (source, destination))
+        return 'remote'
+    if move and not os.path.exists(destination) and \
+       same_filesystem(source, destination):
+        parent = os.path.dirname(destination)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        os.rename(source, destination)
+        log.debug('Moved %s to %s.' % (source, destination))
+        return 'rename'
+    return copy_tree(source, destination, mode)
+
+def is_remote(path):
+    """Return True if path is a remote rsync location (host:path).
+
+    """
+    return ':' in path.split('/')[0]
+
+def fanout_tree(source, destinations, mode='auto'):
+    """Populate several destinations with the contents of a single source.
+    source: full path to the directory to copy from.
+    destinations: list of full paths to populate.
+    mode: one of COPY_MODES.
+
+    The first destination is copied from source. The remaining destinations
+    are copied from the first, which is always on the same filesystem as its
+    siblings, so reflinks and hardlinks can be shared between them even when
+    source lives elsewhere (e.g. /tmp).
+
+    """
+    destinations = list(destinations)
+    if not destinations:
+        return
+    first = destinations[0]
+    copy_tree(source, first, mode)
+    for destination in destinations[1:]:
+        copy_tree(first, destination, mode)
+
+def sync_tree(source, destination, delete=False, workers=WORKERS):
+    """Sync the contents of directory source into directory destination.
+    source: full path to the directory to copy from.
+    destination: full path to the directory to copy into (created if missing).
+    delete: bool. Remove entries from destination that are not in source.
+    workers: number of rsync processes to run in parallel.
+    returns: tuple of (files transferred, bytes transferred).
+
+    The tree is split into subtrees which are spread over workers buckets of
+    about equal weight (file count and size), and each bucket is synced by its
+    own rsync. Deletion runs once over the whole tree after all buckets have
+    been synced.
+
+    """
+    log = logger.logging.getLogger('pantheon.filetools.sync')
+    source = source.rstrip('/')
+    if not os.path.exists(destination):
+        os.makedirs(destination)
+
+    buckets = _balance(source, workers)
+    results = list()
+    errors = list()
+
+    def run(paths):
+        try:
+            results.append(_rsync(source, destination, ['-r', '--files-from=-'],
+                                  '\n'.join(paths)))
+        except Exception, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(bucket,)) \
+               for bucket in buckets if bucket]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    if delete:
+        # Transfers nothing: only removes extraneous destination entries.
+        _rsync(source, destination, ['--delete', '--existing',
+                                     '--ignore-existing'])
+
+    files = sum([r[0] for r in results])
+    size = sum([r[1] for r in results])
+    log.info('Synced %s to %s with %s workers: %s files (%s bytes) ' \
+             'transferred.' % (source, destination, len(threads), files, size))
+    return (files, size)
+
+def _balance(source, workers, depth=3):
+    """Split the tree under source into workers lists of relative paths.
+
+    Top level entries are weighed by the number and size of the files they
+    contain. Directories heavier than a fair share are split into their own
+    entries (up to depth levels down) so a single large directory does not
+    end up in one bucket. Units are then assigned heaviest first to the
+    lightest bucket.
+
+    """
+    weights = dict()
+    children = dict()
+
+    def add(path, weight):
+        # Credit weight to path and its ancestors, up to depth levels down.
+        for i in range(1, min(len(path), depth + 1) + 1):
+            key = '/'.join(path[:i])
+            if key not in weights:
+                weights[key] = 0
+                children.setdefault('/'.join(path[:i - 1]), list()).append(key)
+            weights[key] += weight
+
+    for root, dirs, files in walk(source):
+        rel = os.path.relpath(root, source)
+        parts = [] if rel == '.' else rel.split(os.sep)
+        for name in dirs:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                files.append(name)
+            elif len(parts) <= depth:
+                # Registered even when empty, so it is still created.
+                add(parts + [name], 0)
+        for name in files:
+            try:
+                size = os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+            add(parts + [name], 1 + size / BYTES_PER_FILE)
+
+    top = children.get('', list())
+    share = max(1, sum([weights[k] for k in top]) / max(1, workers))
+    units = list()
+    stack = list(top)
+    while stack:
+        key = stack.pop()
+        if weights[key] > share and children.get(key):
+            # Split into the directory's own entries.
+            stack.extend(children[key])
+        else:
+            units.append((weights[key], key))
+
+    buckets = [(0, i, list()) for i in range(max(1, workers))]
+    heapq.heapify(buckets)
+    for weight, key in sorted(units, reverse=True):
+        total, i, paths = heapq.heappop(buckets)
+        paths.append(key)
+        heapq.heappush(buckets, (total + weight, i, paths))
+    return [paths for total, i, paths in buckets]
+
+def _rsync(source, destination, options, stdin=None):
+    """Run a local rsync of source/ to destination/.
+    returns: tuple of (files transferred, bytes transferred) from --stats.
+
+    """
+    command = ['rsync', '-a', '--stats'] + options + ['%s/' % source,
+                                                     '%s/' % destination]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate(stdin)
+    if process.returncode != 0:
+        raise OSError('rsync exited with status %s: %s' % (process.returncode,
+                                                           err.strip()))
+    files = re.search(r'Number of (?:regular )?files transferred: ([\d,]+)',
+                      out)
+    size = re.search(r'Total transferred file size: ([\d,]+)', out)
+    return (int(files.group(1).replace(',', '')) if files else 0,
+            int(size.group(1).replace(',', '')) if size else 0)
+
+def same_filesystem(source, destination):
+    """Return True if source and destination are on the same device.
+
+    """
+    # Destination may not exist yet, check the closest existing parent.
+    while not os.path.exists(destination):
+        destination = os.path.dirname(destination)
+    return os.stat(source).st_dev == os.stat(destination).st_dev
+
+def reflink_supported(source, destination):
+    """Return True if files can be reflinked from source to destination.
+
+    Both must be on the same filesystem, and that filesystem must support
+    copy-on-write clones. This is probed once per filesystem by reflinking a
+    small file with 'cp --reflink=always' (any recent cp understands the
+    option, whether or not the filesystem supports it).
+
+    """
+    if not same_filesystem(source, destination):
+        return False
+    while not os.path.exists(destination):
+        destination = os.path.dirname(destination)
+    device = os.stat(destination).st_dev
+    if device not in _REFLINK_SUPPORTED:
+        fd, probe = tempfile.mkstemp(prefix='.reflink', dir=destination)
+        try:
+            os.write(fd, 'probe')
+            os.close(fd)
+            with settings(hide('everything'), warn_only=True):
+                result = local('cp --reflink=always %s %s.clone' % (probe,
+                                                                   probe))
+            _REFLINK_SUPPORTED[device] = not result.failed
+        finally:
+            for path in (probe, probe + '.clone'):
+                if os.path.exists(path):
+                    os.remove(path)
+    return _REFLINK_SUPPORTED[device]
+
+def scrub_metadata(base, patterns=VCS_PATTERNS):
+    """Remove all files and directories matching patterns under base.
+    base: full path to the directory tree to clean.
+    patterns: sequence of shell-style name patterns to remove.
+    returns: tuple of (entries removed, bytes reclaimed).
+
+    The tree is walked once. Matching directories are pruned from the walk
+    and removed whole, so their contents are never visited twice.
+
+    """
+    log = logger.logging.getLogger('pantheon.filetools.scrub')
+    removed = 0
+    reclaimed = 0
+
+    def matches(name):
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    for root, dirs, files in walk(base, topdown=True):
+        for name in [d for d in dirs if matches(d)]:
+            path = os.path.join(root, name)
+            dirs.remove(name)
+            if os.path.islink(path):
+                reclaimed += os.lstat(path).st_size
+                os.remove(path)
+            else:
+                reclaimed += tree_size(path)
+                shutil.rmtree(path)
+            removed += 1
+        for name in [f for f in files if matches(f)]:
+            path = os.path.join(root, name)
+            reclaimed += os.lstat(path).st_size
+            os.remove(path)
+            removed += 1
+
+    log.info('Removed %s metadata entries (%s bytes) from %s.' % (removed,
+                                                                 reclaimed,
+                                                                 base))
+    return (removed, reclaimed)
+
+def tree_size(path):
+    """Return the total size in bytes of all entries under path.
+
+    """
+    size = os.lstat(path).st_size
+    for root, dirs, files in walk(path):
+        for name in dirs + files:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
@@ -1,16 +1,43 @@
+import errno
+import fcntl
+import json
 import os
+import re
+import subprocess
 import sys
+import time
 
 from fabric.api import *
 
+import logger
 import pantheon
+import permtools
+
+# Repo status snapshots are stored in the project's state directory.
+REPO_STATUS_CACHE = 'pantheon_repo_status.json'
+
+# Pushes waiting to be applied to dev are queued in the state directory.
+HOOK_EVENT_DIR = 'pantheon_events'
+
+# Repository maintenance thresholds: loose objects before an incremental
+# repack, and packs before they are consolidated into one.
+MAX_LOOSE_OBJECTS = 256
+MAX_PACKS = 20
+
+# Unreachable objects younger than this are never pruned, so objects written
+# by a concurrent fetch or push (not yet referenced) are left alone.
+PRUNE_EXPIRE = '2.weeks.ago'
 
 def post_receive_hook(params):
     """Perform post-receive actions when changes are made to git repo.
     params: hook params from git stdin.
 
-    NOTE: we use 'env -i' to clear environmental variables git has set when
-    running hook operations.
+    Outside of Jenkins jobs the push is only queued, and a background worker
+    updates dev, so the pusher does not wait for the checkout and Jenkins.
+    Several pushes queued while the worker is busy are applied as one
+    update. Inside a Jenkins job (BUILD_TAG is set), or when the push can't
+    be queued (e.g. the state directory is not writable), the update runs
+    synchronously.
 
     """
     (project, old_rev, new_rev) = _parse_hook_params(params)
@@ -21,28 +48,390 @@ def post_receive_hook(params):
     if not os.path.exists(dest):
         print "\n\nWARNING: No development environment for " + \
               "'%s' was found.\n" % (project)
-    # Development environment exists.
+    elif os.environ.get('BUILD_TAG'):
+        update_dev(project, old_rev, new_rev)
     else:
-        with cd(dest):
-            # Hide output from showing on git's report back to user.
-                with settings(hide('running', 'warnings'), warn_only=True):
-                    dev_update = local('env -i git pull')
-                # Output status to the git push initiator.
-                if dev_update.failed:
-                    print "\n\nWARNING: The development environment could" + \
-                    "not be updated. Please review any error messages, and " + \
-                    "resolve any conflicts in /var/www/%s/dev\n" % project
-                    print "ERROR:"
-                    print dev_update.stderr + "\n\n"
-                else:
-                    print "\nDevelopment environment updated.\n"
+        try:
+            queue_dir = _get_event_dir(project)
+            _queue_event(queue_dir, old_rev, new_rev)
+        except (IOError, OSError), e:
+            print "\nWARNING: Unable to queue the update (%s), " % e + \
+                  "updating the development environment now.\n"
+            update_dev(project, old_rev, new_rev)
+            return
+        last = pantheon.load_json(os.path.join(queue_dir, 'last_result'))
+        if last and last.get('failed'):
+            print "\nWARNING: The previous development environment " + \
+                  "update failed:\n%s" % last.get('message')
+        _spawn_worker(project)
+        print "\nDevelopment environment update queued.\n"
+
+def update_dev(project, old_rev=None, new_rev=None):
+    """Pull the latest changes into the dev environment.
+    project: project name.
+    old_rev: revision before the push (default: dev's current HEAD).
+    new_rev: revision after the push (default: dev's HEAD after the pull).
+    returns: tuple of (failed, message).
+
+    NOTE: we use 'env -i' to clear environmental variables git has set when
+    running hook operations.
+
+    """
+    webroot = pantheon.PantheonServer().webroot
+    dest = os.path.join(webroot, project, 'dev')
+    with cd(dest):
+        # Hide output from showing on git's report back to user.
+        with settings(hide('running', 'warnings'), warn_only=True):
+            if not old_rev:
+                old_rev = local('env -i git rev-parse HEAD').rstrip('\n')
+            dev_update = local('env -i git pull')
+        # Output status to the git push initiator.
+        if dev_update.failed:
+            message = "\n\nWARNING: The development environment could" + \
+            "not be updated. Please review any error messages, and " + \
+            "resolve any conflicts in /var/www/%s/dev\n" % project + \
+            "ERROR:\n" + dev_update.stderr + "\n\n"
+        else:
+            message = "\nDevelopment environment updated.\n"
+            _update_permissions(dest, old_rev, new_rev or 'HEAD')
+    print message
+
+    with hide('running'):
+        # If not inside a jenkins job, send back data about repo and drupal.
+        # Otherwise, we assume the job we are inside of will do this.
+        if not os.environ.get('BUILD_TAG'):
+            local('curl http://127.0.0.1:8090/job/post_hook_status/' + \
+                  'buildWithParameters?project=%s' % project)
+    return (dev_update.failed, message)
+
+def process_hook_events(project):
+    """Apply queued pushes to the dev environment (background worker).
+    project: project name.
+
+    Only one worker runs per project (flock). All events queued when the
+    worker wakes up are coalesced into one pull, one permissions update and
+    one Jenkins notification. Events queued meanwhile are picked up by the
+    next iteration.
+
+    """
+    queue_dir = _get_event_dir(project)
+    lock = os.open(os.path.join(queue_dir, '.lock'), os.O_RDONLY | os.O_CREAT,
+                   0664)
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # Another worker holds the lock and will see our events.
+            return
+        events = sorted([name for name in os.listdir(queue_dir) \
+                         if name.endswith('.event')])
+        if events:
+            failed, message = update_dev(project)
+            pantheon.save_json(os.path.join(queue_dir, 'last_result'),
+                               {'failed': failed,
+                                'message': message.strip(),
+                                'events': len(events),
+                                'time': time.time()})
+            for name in events:
+                os.remove(os.path.join(queue_dir, name))
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        # Events queued after the listing are handled by another pass.
+        if not [name for name in os.listdir(queue_dir) \
+                if name.endswith('.event')]:
+            return
+
+def _get_event_dir(project):
+    """Return (and create) the directory queued push events are stored in.
+
+    """
+    queue_dir = os.path.join(pantheon.get_state_dir(project), HOOK_EVENT_DIR)
+    if not os.path.isdir(queue_dir):
+        try:
+            os.makedirs(queue_dir)
+            # Pushes from every member of the group queue events here.
+            os.chmod(queue_dir, 02775)
+        except OSError, e:
+            # Created by a concurrent push.
+            if e.errno != errno.EEXIST:
+                raise
+    return queue_dir
+
+def _queue_event(queue_dir, old_rev, new_rev):
+    """Record a push in the event queue. Raises IOError/OSError on failure.
+
+    """
+    path = os.path.join(queue_dir, '%.6f-%s.event' % (time.time(),
+                                                      os.getpid()))
+    # Written under a name the worker ignores, then renamed into place.
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump({'old_rev': old_rev, 'new_rev': new_rev}, f)
+    os.rename(temp, path)
+
+def _spawn_worker(project):
+    """Start process_hook_events for project, detached from the push.
+
+    """
+    # Drop the variables git sets for hooks (GIT_DIR etc.).
+    env = dict([(k, v) for k, v in os.environ.items() \
+                if not k.startswith('GIT_')])
+    code = "import sys; sys.path.append('/opt/pantheon'); " + \
+           "from fab.pantheon import gittools; " + \
+           "gittools.process_hook_events(%r)" % project
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen([sys.executable, '-c', code], env=env,
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+
+def get_changed_paths(old_rev, new_rev):
+    """Return list of paths that differ between two revisions.
+    old_rev: commit hash or ref. If None, or all zeros (a new ref), the
+             complete tree of new_rev is returned.
+    new_rev: commit hash or ref.
+
+    Must be run from within the working tree (e.g. inside a cd() block).
+
+    """
+    with hide('running'):
+        if not old_rev or old_rev.strip('0') == '':
+            paths = local('git ls-tree -r -z --name-only %s' % new_rev)
+        else:
+            paths = local('git diff --name-only -z %s %s' % (old_rev, new_rev))
+    return [path for path in paths.split('\0') if path]
+
+def clone_shared(repo, destination, branch):
+    """Clone repo to destination, sharing its object store.
+    repo: full path to the repository to clone (e.g. the central repository).
+    destination: full path to the new working-tree.
+    branch: branch to check out.
+
+    The clone borrows objects from repo through alternates instead of
+    copying or hardlinking them. Objects must therefore never be pruned
+    from repo while they may still be referenced by clones.
+
+    """
+    local('git clone --shared -b %s %s %s' % (branch, repo, destination))
+
+def attach_shared_repo(repo, working_dir, branch):
+    """Turn an existing directory into a checkout of branch from repo.
+    repo: full path to the repository (e.g. the central repository).
+    working_dir: full path to the directory to attach git metadata to.
+    branch: branch to attach to.
+
+    Creates the same metadata a clone would (origin remote, tracking branch,
+    index of branch) without a throwaway clone, sharing objects with repo.
+    The files in working_dir are left untouched, so they show up as changes
+    against branch.
+
+    """
+    git_dir = os.path.join(working_dir, '.git')
+    with cd(working_dir):
+        local('git init -q')
+        with open(os.path.join(git_dir, 'objects/info/alternates'), 'w') as f:
+            f.write(os.path.join(repo, 'objects') + '\n')
+        rev = local('git --git-dir=%s rev-parse refs/heads/%s' % (repo,
+                                                             branch)).rstrip()
+        local('git remote add origin %s' % repo)
+        local('git update-ref refs/remotes/origin/%s %s' % (branch, rev))
+        local('git update-ref refs/heads/%s %s' % (branch, rev))
+        local('git symbolic-ref HEAD refs/heads/%s' % branch)
+        local('git config branch.%s.remote origin' % branch)
+        local('git config branch.%s.merge refs/heads/%s' % (branch, branch))
+        local('git read-tree %s' % rev)
+
+def set_alternates(repo_path, objects):
+    """Point a repository's alternates at objects, if it has any.
+    repo_path: full path to the working-tree.
+    objects: full path to the objects dir to borrow from.
+
+    """
+    alternates = os.path.join(repo_path, '.git/objects/info/alternates')
+    if os.path.exists(alternates):
+        with open(alternates, 'w') as f:
+            f.write(objects + '\n')
+
+def get_repo_stats(git_dir):
+    """Return object and pack statistics of a repository.
+    git_dir: full path to the git directory (e.g. <repo>/.git or a bare repo).
+    returns: dict of the 'git count-objects -v' values (ints, e.g. 'count',
+             'packs', 'size-pack') and 'commit-graph' (bool).
+
+    """
+    with settings(hide('running', 'stdout')):
+        output = local('git --git-dir=%s count-objects -v' % git_dir)
+    stats = dict()
+    for line in output.splitlines():
+        key, sep, value = line.partition(':')
+        if sep and value.strip().isdigit():
+            stats[key.strip()] = int(value)
+    info = os.path.join(git_dir, 'objects/info')
+    stats['commit-graph'] = \
+            os.path.exists(os.path.join(info, 'commit-graph')) or \
+            os.path.isdir(os.path.join(info, 'commit-graphs'))
+    return stats
+
+def maintain_repo(git_dir, shared=False, nice=''):
+    """Repack, write the commit-graph and prune a repository where needed.
+    git_dir: full path to the git directory.
+    shared: bool. Other repositories borrow objects from this one (through
+            alternates), so unreachable objects are kept and never pruned.
+    nice: command prefix to run git with (e.g. 'nice -n 19 ionice -c 3').
+    returns: list of the maintenance steps that were run.
 
+    Loose objects are packed incrementally once there are MAX_LOOSE_OBJECTS
+    of them. Only once MAX_PACKS packs exist are they consolidated into one.
+    Objects borrowed from alternates are never copied in (-l).
+
+    """
+    log = logger.logging.getLogger('pantheon.gittools.maintain_repo')
+    git = '%s git --git-dir=%s' % (nice, git_dir)
+    stats = get_repo_stats(git_dir)
+    steps = list()
+    with settings(hide('running', 'stdout'), warn_only=True):
+        if stats.get('packs', 0) >= MAX_PACKS:
+            keep = ' --keep-unreachable' if shared else ''
+            result = local('%s repack -a -d -l -q%s' % (git, keep))
+            steps.append('repack -a')
+        elif stats.get('count', 0) >= MAX_LOOSE_OBJECTS:
+            result = local('%s repack -d -l -q' % git)
+            steps.append('repack')
+        else:
+            result = None
+        if result is not None and result.failed:
+            log.warning('Repack of %s failed: %s' % (git_dir, result.stderr))
+        if steps or not stats['commit-graph']:
+            # Not supported before git 2.18; skipped if it fails.
+            result = local('%s commit-graph write --reachable' % git)
+            if not result.failed:
+                steps.append('commit-graph')
+        if not shared and (stats.get('count', 0) or stats.get('garbage', 0)):
+            result = local('%s prune --expire=%s' % (git, PRUNE_EXPIRE))
+            if not result.failed:
+                steps.append('prune')
+    log.info('Maintained %s (%s loose objects, %s packs): %s.' % (git_dir,
+                stats.get('count', 0), stats.get('packs', 0),
+                ', '.join(steps) or 'nothing to do'))
+    return steps
+
+def preview_merge(repo, ours, theirs):
+    """Compute the merge of theirs into ours without touching a working-tree.
+    repo: full path to the repository (may be bare).
+    ours: commit or ref being merged into.
+    theirs: commit or ref being merged.
+    returns: dict with 'clean' (bool), 'conflicts' (paths that conflict) and
+             'changed' (paths the merge changes in ours).
+
+    Uses 'git merge-tree --write-tree' where available. Older versions of git
+    fall back to the trivial three-way 'git merge-tree <base> <ours>
+    <theirs>' output, where conflicting paths carry conflict markers.
+
+    """
+    with cd(repo):
+        with settings(hide('running', 'warnings'), warn_only=True):
+            base = local('git merge-base %s %s' % (ours, theirs)).rstrip('\n')
+            changed = local('git diff --name-only -z %s %s' % (base or ours,
+                                                              theirs))
+            merge = local('git merge-tree --write-tree --name-only ' + \
+                          '--no-messages %s %s' % (ours, theirs))
+            lines = merge.split('\n')
+            if re.match('^[0-9a-f]{40}$', lines[0]):
+                # First line is the resulting tree, then conflicted paths.
+                conflicts = [p for p in lines[1:] if p]
+            else:
+                merge = local('git merge-tree %s %s %s' % (base, ours,
+                                                           theirs))
+                conflicts = _parse_trivial_merge(merge)
+    return {'clean': not conflicts,
+            'conflicts': sorted(set(conflicts)),
+            'changed': [path for path in changed.split('\0') if path]}
+
+def _parse_trivial_merge(output):
+    """Return conflicting paths from old-style 'git merge-tree' output.
+
+    """
+    conflicts = list()
+    path = None
+    for line in output.split('\n'):
+        if line and not line.startswith((' ', '@', '+', '-')):
+            # Section header, e.g. 'changed in both'.
+            path = None
+        elif line.startswith('  ') and path is None:
+            # '  our    100644 <sha> <path>'
+            path = line.split(None, 3)[-1]
+        elif line.startswith('+<<<<<<<') and path:
+            conflicts.append(path)
+    return conflicts
+
+def get_modified_paths():
+    """Return paths with uncommitted changes in the current working-tree.
+    returns: list of paths relative to the working-tree root: modified,
+             deleted, untracked (not ignored) and both sides of renames.
+
+    Must be run inside the working-tree, e.g. in: with cd(path):
+
+    Status runs in the default untracked mode, the only one that uses the
+    untracked cache (core.untrackedCache). Wholly untracked directories are
+    then listed on their own, so only new directories are walked.
+
+    """
+    with hide('running'):
+        status = local('git status --porcelain -z --untracked-files=normal')
+    paths = list()
+    new_dirs = list()
+    entries = iter(status.split('\0'))
+    for entry in entries:
+        if not entry:
+            continue
+        path = entry[3:]
+        if entry[:2] == '??' and path.endswith('/'):
+            new_dirs.append(path)
+            continue
+        paths.append(path)
+        # Renames and copies are followed by their source path.
+        if entry[0] in 'RC':
+            paths.append(next(entries))
+    if new_dirs:
         with hide('running'):
-            # If not inside a jenkins job, send back data about repo and drupal.
-            # Otherwise, we assume the job we are inside of will do this.
-            if not os.environ.get('BUILD_TAG'):
-                local('curl http://127.0.0.1:8090/job/post_hook_status/' + \
-                      'buildWithParameters?project=%s' % project)
+            others = local('git ls-files -z --others --exclude-standard -- ' + \
+                           ' '.join(["'%s'" % d.replace("'", "'\\''") \
+                                     for d in new_dirs]))
+        paths.extend([p for p in others.split('\0') if p])
+    return paths
+
+def stage_paths(repo_path, paths):
+    """Stage additions, modifications and removals of paths in the index.
+    repo_path: full path to the working-tree.
+    paths: list of paths relative to repo_path.
+
+    """
+    update = subprocess.Popen(['git', 'update-index', '--add', '--remove',
+                               '-z', '--stdin'], cwd=repo_path,
+                              stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = update.communicate('\0'.join(paths) + '\0')[1]
+    if update.returncode != 0:
+        raise OSError('git update-index failed: %s' % err.strip())
+
+def _update_permissions(dest, old_rev, new_rev):
+    """Make paths changed by a push group writable in the dev environment.
+    dest: full path to the dev environment.
+    old_rev: revision before the push.
+    new_rev: revision after the push.
+
+    The hook runs as the pushing user, so entries owned by someone else are
+    skipped rather than treated as an error.
+
+    """
+    with settings(hide('running', 'warnings'), warn_only=True):
+        paths = get_changed_paths(old_rev, new_rev)
+    acl_group = None
+    if os.path.exists('/etc/pantheon/ldapgroup'):
+        acl_group = pantheon.PantheonServer().get_ldap_group()
+    permtools.set_path_permissions(dest,
+                                   [p for p in paths \
+                                    if not p.startswith('sites/default/files/')],
+                                   group_writable=True,
+                                   acl_group=acl_group,
+                                   strict=False)
 
 def _parse_hook_params(params):
     """Parse the params received during a git push.
@@ -54,6 +443,60 @@ def _parse_hook_params(params):
     return (project, revision_old, revision_new)
 
 
+def read_ref(git_dir, ref):
+    """Return the sha a ref points to, reading the repository directly.
+    git_dir: full path to the repository (.git dir or bare repository).
+    ref: full ref name, e.g. refs/heads/master.
+    returns: sha, or None if the ref does not exist.
+
+    """
+    for i in range(5):
+        try:
+            with open(os.path.join(git_dir, ref), 'r') as f:
+                value = f.read().strip()
+        except IOError:
+            return get_packed_refs(git_dir).get(ref)
+        if not value.startswith('ref: '):
+            return value
+        # Follow symbolic refs, e.g. HEAD.
+        ref = value[5:]
+    return None
+
+def get_packed_refs(git_dir):
+    """Return dict of ref -> sha from a repository's packed-refs file.
+
+    """
+    refs = dict()
+    try:
+        with open(os.path.join(git_dir, 'packed-refs'), 'r') as f:
+            for line in f:
+                if line[0] in '#^':
+                    continue
+                sha, ref = line.strip().split(' ', 1)
+                refs[ref] = sha
+    except IOError:
+        pass
+    return refs
+
+def get_refs(git_dir, prefix='refs/heads/'):
+    """Return dict of ref -> sha for all refs starting with prefix.
+    git_dir: full path to the repository (.git dir or bare repository).
+
+    Loose refs are read directly and take precedence over packed-refs.
+
+    """
+    refs = dict([(ref, sha) for ref, sha in get_packed_refs(git_dir).items() \
+                 if ref.startswith(prefix)])
+    base = os.path.join(git_dir, prefix)
+    for root, dirs, files in os.walk(base):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, 'r') as f:
+                value = f.read().strip()
+            if len(value) == 40:
+                refs[os.path.relpath(path, git_dir)] = value
+    return refs
+
 class GitRepo():
 
     def __init__(self, project):
@@ -61,10 +504,73 @@ class GitRepo():
         self.repo = os.path.join('/var/git/projects', self.project)
         self.server = pantheon.PantheonServer()
         self.project_path = os.path.join(self.server.webroot, self.project)
+        self.log = logger.logging.getLogger('pantheon.gittools.GitRepo')
 
     def get_repo_status(self):
         """Return dict of dev/test and test/live diffs, and last 10 log entries.
 
+        The report is cached in the project's state directory, keyed by the
+        commits it was built from. Only the parts whose commits have moved
+        since are recomputed.
+
+        """
+        heads = dict()
+        for env in ('dev', 'test', 'live'):
+            git_dir = os.path.join(self.project_path, env, '.git')
+            heads[env] = read_ref(git_dir, 'refs/heads/%s' % self.project)
+        heads['central'] = read_ref(self.repo, 'refs/heads/%s' % self.project)
+        keys = {'diff_dev_test': [heads['test'], heads['dev']],
+                'diff_test_live': [heads['live'], heads['test']],
+                'log': [heads['central']]}
+
+        cache_file = os.path.join(pantheon.get_state_dir(self.project),
+                                  REPO_STATUS_CACHE)
+        cache = pantheon.load_json(cache_file) or dict()
+        missing = [name for name in keys if None in keys[name] or \
+                   cache.get(name, dict()).get('key') != keys[name]]
+        if not missing:
+            return dict([(name, cache[name]['value']) for name in keys])
+
+        try:
+            status = self._get_repo_status_by_commit(heads, missing)
+        except Exception, e:
+            # E.g. commits not (yet) in the central repository.
+            self.log.debug('Falling back to git commands: %s' % e)
+            status = self._get_repo_status_commands()
+
+        for name in missing:
+            cache[name] = {'key': keys[name], 'value': status[name]}
+        pantheon.save_json(cache_file, cache)
+        return dict([(name, cache[name]['value']) for name in keys])
+
+    def _get_repo_status_by_commit(self, heads, parts):
+        """Build parts of the repo status in the central repository, using
+        the branch tips read from disk.
+        heads: dict of dev, test, live and central branch tips.
+        parts: names of the parts of the status to compute.
+
+        Produces the same report as _get_repo_status_commands(), with one git
+        call per part. Environments are compared by commit, so no tags need
+        describing.
+
+        """
+        if None in heads.values():
+            raise ValueError('Branch %s not found in all repositories.' % \
+                             self.project)
+        status = dict()
+        if 'diff_dev_test' in parts:
+            status['diff_dev_test'] = self._get_diff_stat(heads['test'],
+                                                          heads['dev'])
+        if 'diff_test_live' in parts:
+            status['diff_test_live'] = self._get_diff_stat(heads['live'],
+                                                           heads['test'])
+        if 'log' in parts:
+            status['log'] = self._get_log(10)
+        return status
+
+    def _get_repo_status_commands(self):
+        """Build the repo status by running git commands.
+
         """
         head = self._get_last_commit('dev')
         test = self._get_last_commit('test')
@@ -87,12 +593,15 @@ class GitRepo():
 
         returns commit hash for dev, or current tag for test/live.
 
+        Tags only exist in the central repository, so test/live commits are
+        described there.
+
         """
-        with cd(os.path.join(self.project_path, env)):
-            if env == 'dev':
-                ref = local('git rev-parse refs/heads/%s' %  self.project)
-            else:
-                ref = local('git describe --tags %s' % self.project).rstrip('\n')
+        git_dir = os.path.join(self.project_path, env, '.git')
+        ref = read_ref(git_dir, 'refs/heads/%s' % self.project)
+        if env != 'dev':
+            with cd(self.repo):
+                ref = local('git describe --tags %s' % ref).rstrip('\n')
         return ref
 
     def _get_diff_stat(self, base, other):
@@ -114,4 +623,3 @@ class GitRepo():
         with cd(self.repo):
             log = local('git log -n%s %s' % (num_entries, self.project))
         return log
-
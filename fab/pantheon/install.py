@@ -8,6 +8,8 @@ import tempfile
 from fabric.api import *
 
 import drupaltools
+import filetools
+import gittools
 import pantheon
 import project
 
@@ -71,24 +73,16 @@ class InstallTools(project.BuildTools):
         local('drush make %s %s' % (makefile, self.working_dir), capture=False)
 
         # Makefiles could use vc repos as sources, remove all metadata.
-        with cd(self.working_dir):
-            with settings(hide('warnings'), warn_only=True):
-                local("find . -depth -name .git -exec rm -fr {} \;")
-                local("find . -depth -name .bzr -exec rm -fr {} \;")
-                local("find . -depth -name .svn -exec rm -fr {} \;")
-                local("find . -depth -name CVS -exec rm -fr {} \;")
+        filetools.scrub_metadata(self.working_dir,
+                                 ('.git', '.bzr', '.svn', 'CVS'))
 
         # Create a project branch
         with cd(os.path.join('/var/git/projects', self.project)):
             local('git branch %s' % self.project)
 
-        # Get the .git data for the project repo, and put in the working_dir
-        tempdir = tempfile.mkdtemp()
-        local('git clone /var/git/projects/%s -b %s %s' % (self.project,
-                                                           self.project,
-                                                           tempdir))
-        local('mv %s %s' % (os.path.join(tempdir, '.git'), self.working_dir))
-        local('rm -r %s' % tempdir)
+        # Attach the project repo's git data to the working_dir.
+        gittools.attach_shared_repo('/var/git/projects/%s' % self.project,
+                                    self.working_dir, self.project)
 
         # Commit the result of the makefile.
         with cd(self.working_dir):
@@ -1,12 +1,18 @@
 import os
+import tarfile
 import tempfile
+import urllib2
+import zipfile
 
 import dbtools
 import drupaltools
+import filetools
+import gittools
 import pantheon
 import project
 import postback
 import logger
+import rangeable_file
 
 from fabric.api import *
 #TODO: Improve the logging messages
@@ -63,6 +69,176 @@ def get_onramp_profile(base):
     return 'import'
 
 
+def inspect_archive(url):
+    """Validate an onramp archive by reading only its index.
+    url: url of the archive (file:/// for local archives).
+    returns: dict report of the archive, or None if it could not be inspected.
+
+    Zip archives are inspected through their central directory, fetched with
+    range requests for remote urls. Uncompressed tars have no index, but
+    their member headers can be read in turn, seeking over the data.
+    Compressed tars would have to be decompressed in full, so they are not
+    inspected (returns None) and are checked after their single extract.
+    Archives that could never be imported fail the build here rather than
+    after a full download and extract.
+
+    """
+    log = logger.logging.getLogger('pantheon.onramp.inspect')
+    try:
+        index = _read_archive_index(url)
+    except (IOError, urllib2.URLError, tarfile.TarError,
+            zipfile.BadZipfile), e:
+        # Includes servers without range support or a Content-Length.
+        log.warning('Unable to inspect archive before download: %s' % e)
+        return None
+    if index is None:
+        log.info('Compressed archive, checking it after extraction.')
+        return None
+    paths, dirs, contents = index
+
+    report = {'size': sum(paths.values()),
+              'profile': 'import'}
+    # Not all archives have entries for directories, derive them from paths.
+    for path in paths.keys():
+        parent = os.path.dirname(path)
+        while parent and parent not in dirs:
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+
+    # Pantheon backups contain a config file next to the environments.
+    for path in paths:
+        if os.path.basename(path) == 'pantheon.backup' and \
+           os.path.join(os.path.dirname(path), 'live') in dirs:
+            report['profile'] = 'restore'
+            log.info('Pantheon backup found (%s bytes).' % report['size'])
+            return report
+
+    roots = [d for d in dirs.union(['']) \
+             if os.path.join(d, 'index.php') in paths and \
+                os.path.join(d, 'sites') in dirs]
+    if not roots:
+        err = 'Cannot locate drupal install in archive.'
+        log.error(err)
+        postback.build_error(err)
+    # Match get_drupal_root(), which takes the shallowest match.
+    root = min(roots, key=lambda d: (d.count('/'), d))
+    report['drupal_root'] = root
+
+    sites_dir = os.path.join(root, 'sites')
+    report['sites'] = sorted([os.path.basename(os.path.dirname(p)) \
+                              for p in paths \
+                              if os.path.basename(p) == 'settings.php' and \
+                              os.path.dirname(os.path.dirname(p)) == sites_dir])
+    if len(report['sites']) > 1:
+        err = 'Multiple settings.php files were found:\n' + \
+              '\n'.join(report['sites'])
+        log.error(err)
+        postback.build_error(err)
+    elif not report['sites']:
+        err = 'Error: No settings.php files were found.'
+        log.error(err)
+        postback.build_error(err)
+
+    report['dumps'] = sorted([os.path.basename(p) for p in paths \
+                              if os.path.dirname(p) == root and \
+                              os.path.splitext(p)[1] in ['.sql', '.mysql']])
+    if not report['dumps']:
+        err = 'No database dump files were found (*.mysql or *.sql)'
+        log.error(err)
+        postback.build_error(err)
+    elif len(report['dumps']) > 1:
+        err = 'Multiple database dump files were found:\n' + \
+              '\n'.join(report['dumps'])
+        log.error(err)
+        postback.build_error(err)
+
+    report['version'] = None
+    for location in ['modules/system/system.module', 'includes/bootstrap.inc']:
+        data = contents.get(os.path.join(root, location))
+        if data:
+            report['version'] = drupaltools.parse_version_string(data)
+        if report['version']:
+            break
+    if not report['version']:
+        err = 'Unable to determine the Drupal version of the archive.'
+        log.error(err)
+        postback.build_error(err)
+
+    log.info('Archive contains Drupal %s site "%s" (%s bytes).' % (
+                     report['version'], report['sites'][0], report['size']))
+    return report
+
+def _read_archive_index(url):
+    """Return the members of the archive at url, without extracting it.
+    url: url of the archive (file:/// for local archives).
+    returns: tuple of (dict of file path: size,
+                       set of directory paths,
+                       dict of file path: head of version file contents)
+             or None for compressed tar archives.
+
+    """
+    # Only the head of these files is needed to find the Drupal version.
+    version_files = ('modules/system/system.module', 'includes/bootstrap.inc')
+
+    if url.startswith('file:///'):
+        fileobj = open(url[7:], 'rb')
+    else:
+        fileobj = rangeable_file.HTTPRangeFile(url)
+
+    try:
+        # gzip and bzip2 streams would have to be decompressed in full.
+        head = fileobj.read(262)
+        if head.startswith(('\x1f\x8b', 'BZh')):
+            return None
+        is_zip = zipfile.is_zipfile(fileobj)
+        # Uncompressed tar headers carry the 'ustar' magic at offset 257.
+        if not is_zip and head[257:262] != 'ustar':
+            return None
+        if is_zip:
+            paths = dict()
+            dirs = set()
+            contents = dict()
+            archive = zipfile.ZipFile(fileobj)
+            for info in archive.infolist():
+                name = os.path.normpath(info.filename).lstrip('/')
+                if info.filename.endswith('/'):
+                    dirs.add(name)
+                    continue
+                paths[name] = info.file_size
+                if name.endswith(version_files):
+                    member = archive.open(info)
+                    contents[name] = member.read(16384)
+                    member.close()
+            archive.close()
+            return (paths, dirs, contents)
+        # Uncompressed: member data is skipped by seeking past it.
+        fileobj.seek(0)
+        archive = tarfile.open(fileobj=fileobj, mode='r:')
+        return _read_tar_index(archive, version_files)
+    finally:
+        fileobj.close()
+
+def _read_tar_index(archive, version_files):
+    """Return the index of an open tar archive, see _read_archive_index().
+
+    """
+    paths = dict()
+    dirs = set()
+    contents = dict()
+    for member in archive:
+        name = os.path.normpath(member.name).lstrip('/')
+        if name == '.':
+            continue
+        if member.isdir():
+            dirs.add(name)
+            continue
+        paths[name] = member.size
+        if member.isfile() and name.endswith(version_files):
+            contents[name] = archive.extractfile(member).read(16384)
+    archive.close()
+    return (paths, dirs, contents)
+
+
 class ImportTools(project.BuildTools):
 
     def __init__(self, project):
@@ -85,13 +261,10 @@ class ImportTools(project.BuildTools):
         self.working_dir = get_drupal_root(extract_location)
 
         # Remove existing VCS files.
+        filetools.scrub_metadata(self.working_dir)
+
         with cd(self.working_dir):
             with settings(hide('warnings'), warn_only=True):
-                local("find . -depth -name '._*' -exec rm -fr {} \;")
-                local("find . -depth -name .git -exec rm -fr {} \;")
-                local("find . -depth -name .bzr -exec rm -fr {} \;")
-                local("find . -depth -name .svn -exec rm -fr {} \;")
-                local("find . -depth -name CVS -exec rm -fr {} \;")
                 # Comment any RewriteBase directives in .htaccess
                 local("sed -i 's/^[^#]*RewriteBase/# RewriteBase/' .htaccess")
 
@@ -125,20 +298,14 @@ class ImportTools(project.BuildTools):
         imported site. Import files into this branch and setup default site.
 
         """
-        # Get git metadata at correct branch/version point.
-        temp_dir = tempfile.mkdtemp()
-        local('git clone -l /var/git/projects/%s -b %s %s' % (self.project,
-                                                              self.project,
-                                                              temp_dir))
-        # Put the .git metadata on top of imported site.
-        with cd(temp_dir):
-            local('git checkout %s' % self.project)
-            local('cp -R .git %s' % self.working_dir)
+        # Put git metadata at correct branch/version point on top of the
+        # imported site.
+        gittools.attach_shared_repo('/var/git/projects/%s' % self.project,
+                                    self.working_dir, self.project)
         with cd(self.working_dir):
             local('rm -f PRESSFLOW.txt')
             # Stomp on any changes to core.
             local('git reset --hard')
-        local('rm -rf %s' % temp_dir)
 
         source = os.path.join(self.working_dir, 'sites/%s' % self.site)
         destination = os.path.join(self.working_dir, 'sites/default')
@@ -191,28 +358,28 @@ class ImportTools(project.BuildTools):
                 rel_path = os.path.relpath(file_dest, path[0])
                 local('ln -s %s %s' % (rel_path, file_path))
 
-        # Change paths in the files table
         (db_username, db_password, db_name) = pantheon.get_database_vars(self, 'dev')
+        db = dbtools.get_connection(database = db_name,
+                                    username = db_username,
+                                    password = db_password)
 
         if self.version == 6:
             file_var = 'file_directory_path'
             file_var_temp = 'file_directory_temp'
-            # Change the base path in files table for Drupal 6
-            local('mysql -u root %s -e "UPDATE files SET filepath = \
-                   REPLACE(filepath,\'%s\',\'%s\');"'% (db_name,
-                                                        file_location,
-                                                        'sites/default/files'))
         elif self.version == 7:
             file_var = 'file_public_path'
             file_var_temp = 'file_temporary_path'
 
+        # Change paths in the files table
+        if file_location and (file_location != 'sites/default/files'):
+            changed = dbtools.rewrite_file_paths(db, file_location,
+                                                 'sites/default/files',
+                                                 self.version)
+            self.log.info('Changed path of %s files.' % changed)
+
         # Change file path drupal variables
-        db = dbtools.MySQLConn(database = db_name,
-                               username = db_username,
-                               password = db_password)
         db.vset(file_var, 'sites/default/files')
         db.vset(file_var_temp, '/tmp')
-        db.close()
 
         # Ignore files directory
         with open(os.path.join(file_dest,'.gitignore'), 'a') as f:
@@ -239,23 +406,34 @@ class ImportTools(project.BuildTools):
                                 'pantheon_login',
                                 'pantheon_apachesolr']
 
-        # Enable modules.
+        (db_username, db_password, db_name) = pantheon.get_database_vars(self, 'dev')
+        db = dbtools.get_connection(database = db_name,
+                                    username = db_username,
+                                    password = db_password)
+
+        # Enable all modules in a single drush bootstrap.
         with settings(hide('warnings'), warn_only=True):
-            for module in required_modules:
-                result = local('drush -by @working_dir en %s' % module)
-                pantheon.log_drush_backend(result, self.log)
-                if result.failed:
-                    # If importing vanilla drupal, this module wont exist.
-                    if module != 'cookie_cache_bypass':
-                        message = 'Could not enable %s module.' % module
-                        self.log.warning('%s\n%s' % (message, result.stderr))
-                        postback.build_warning(message)
-                        print message
-                        print '\n%s module could not be enabled. ' % module + \
-                              'Error Message:'
-                        print '\n%s' % result.stderr
-                else:
-                    self.log.info('%s enabled.' % module)
+            result = local('drush -by @working_dir en %s' % ' '.join(
+                                                            required_modules))
+        pantheon.log_drush_backend(result, self.log)
+
+        # Drush reports a single status for the batch, so check which
+        # modules were actually enabled directly in the system table.
+        enabled = set([row[0] for row in db.execute(
+                      "SELECT name FROM system WHERE type = 'module' " + \
+                      "AND status = 1")])
+        for module in required_modules:
+            if module in enabled:
+                self.log.info('%s enabled.' % module)
+            # If importing vanilla drupal, this module wont exist.
+            elif module != 'cookie_cache_bypass':
+                message = 'Could not enable %s module.' % module
+                self.log.warning('%s\n%s' % (message, result.stderr))
+                postback.build_warning(message)
+                print message
+                print '\n%s module could not be enabled. ' % module + \
+                      'Error Message:'
+                print '\n%s' % result.stderr
 
         if self.version == 6:
             drupal_vars = {
@@ -284,10 +462,6 @@ class ImportTools(project.BuildTools):
                 'search_default_module': 'apachesolr_search'}
 
         # Set variables.
-        (db_username, db_password, db_name) = pantheon.get_database_vars(self, 'dev')
-        db = dbtools.MySQLConn(database = db_name,
-                               username = db_username,
-                               password = db_password)
         for key, value in drupal_vars.iteritems():
             db.vset(key, value)
 
@@ -319,15 +493,15 @@ class ImportTools(project.BuildTools):
              self.log.error('Auto-configuration of ApacheSolr module failed: %s' % mysql_error)
              pass
 
-        db.close()
-
-        # D7: apachesolr config link will not display until cache cleared?
+        # D7: apachesolr config link will not display until cache cleared.
+        # A full 'cc all' also rebuilds the registry, theme and menu.
         with settings(warn_only=True):
-            result = local('drush @working_dir -y cc all')
-            pantheon.log_drush_backend(result, self.log)
+            result = local('drush -by @working_dir cc all')
+        pantheon.log_drush_backend(result, self.log)
 
         # Run updatedb
-        drupaltools.updatedb(alias='@working_dir')
+        result = drupaltools.updatedb(alias='@working_dir')
+        pantheon.log_drush_backend(result, self.log)
 
         # Remove temporary working_dir drush alias.
         alias_file = '/opt/drush/aliases/working_dir.alias.drushrc.php'
@@ -354,8 +528,9 @@ class ImportTools(project.BuildTools):
             for line in lines:
                 f.write(line + '\n')
 
-    def setup_environments(self):
-        super(ImportTools, self).setup_environments('import', self.working_dir)
+    def setup_environments(self, files_mode='auto'):
+        super(ImportTools, self).setup_environments('import', self.working_dir,
+                                                    files_mode)
 
     def setup_permissions(self):
         super(ImportTools, self).setup_permissions('import')
@@ -367,6 +542,7 @@ class ImportTools(project.BuildTools):
         """ Remove leftover temporary import files..
 
         """
+        dbtools.close_connections()
         local('rm -rf %s' % self.working_dir)
         local('rm -rf %s' % self.build_location)
 
@@ -1,4 +1,5 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
+import errno
 import os
 import random
 import string
@@ -17,6 +18,9 @@ from fabric.api import *
 
 ENVIRONMENTS = set(['dev','test','live'])
 TEMPLATE_DIR = '/opt/pantheon/fab/templates'
+# Runtime state (caches, queued events) of each project. Kept outside the
+# git repositories, so it is not backed up and restored with them.
+STATE_DIR = '/var/lib/pantheon/projects'
 
 def get_environments():
     """ Return list of development environments.
@@ -81,19 +85,6 @@ def parse_vhost(path):
             env_vars[var[1]] = var[2]
     return env_vars
 
-def is_drupal_installed(self, environment):
-    """Return True if the Drupal installation process has been completed.
-       project: project name
-       environment: environment name.
-
-    """
-    (username, password, db_name) = get_database_vars(self, environment)
-    with hide('running'):
-        status = local("mysql -u %s -p%s %s -e 'show tables;' | \
-                        awk '/system/'" % (username, password, db_name))
-    # If any data is in status, assume site is installed.
-    return bool(status)
-
 def download(url, prefix='tmp'):
     """Download url to temporary directory and return path to file.
     url: fully qualified url of file to download.
@@ -150,6 +141,71 @@ def get_database_vars(self, env):
             config['db_password'],
             config['db_name'])
 
+def get_state_dir(project):
+    """Return (and create) the runtime state directory of a project.
+    project: project name.
+
+    The directory is group writable (and owned by the group of the central
+    repository), as post-receive hooks of every group member write to it.
+
+    """
+    state_dir = os.path.join(STATE_DIR, project)
+    if not os.path.isdir(state_dir):
+        try:
+            os.makedirs(state_dir)
+            os.chmod(state_dir, 02775)
+            repo = os.path.join('/var/git/projects', project)
+            if os.path.isdir(repo):
+                os.chown(state_dir, -1, os.stat(repo).st_gid)
+        except OSError, e:
+            # Created concurrently, or not permitted (writes will then fail
+            # and be reported by the caller).
+            if e.errno != errno.EEXIST:
+                log = logger.logging.getLogger('pantheon.pantheon.state')
+                log.warning('Unable to create %s: %s' % (state_dir, e))
+    return state_dir
+
+def setup_state_dirs():
+    """Create the state directory of every project on the server.
+    Run as root, as post-receive hooks (run as the pushing user) can only
+    write to an existing directory.
+
+    """
+    for project in os.listdir('/var/git/projects'):
+        get_state_dir(project)
+
+def clear_state(project):
+    """Remove all runtime state of a project (e.g. on restore or removal).
+
+    """
+    state_dir = os.path.join(STATE_DIR, project)
+    if os.path.exists(state_dir):
+        local('rm -rf %s' % state_dir)
+
+def load_json(path):
+    """Return data stored as json at path, or None if missing or unreadable.
+
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def save_json(path, data):
+    """Store data as json at path, replacing the file atomically.
+    Used for caches, so failing to write is logged but not fatal.
+
+    """
+    temp = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(temp, 'w') as f:
+            json.dump(data, f)
+        os.rename(temp, path)
+    except (IOError, OSError), e:
+        log = logger.logging.getLogger('pantheon.pantheon.save_json')
+        log.warning('Unable to write %s: %s' % (path, e))
+
 def configure_root_certificate(pki_server):
     """Helper function that connects to pki.getpantheon.com and configures the
     root certificate used throughout the infrastructure."""
@@ -0,0 +1,339 @@
+import errno
+import grp
+import os
+import pwd
+import re
+import stat
+import subprocess
+import threading
+import Queue
+
+# The scandir package (when installed) avoids a stat() per directory entry.
+try:
+    from scandir import walk
+except ImportError:
+    from os import walk
+
+import logger
+
+# Number of threads used to walk subtrees in parallel.
+WORKERS = 4
+
+def set_tree_permissions(base, owner=None, group=None, dir_mode=None,
+                         file_mode=None, exclude=(), workers=WORKERS,
+                         group_writable=False):
+    """Set ownership and modes on base and everything beneath it.
+    base: full path to the root of the tree.
+    owner: user name to own every entry (None to leave unchanged).
+    group: group name to own every entry (None to leave unchanged).
+    dir_mode: int. Mode for directories, e.g. 0770 (None to leave unchanged).
+    file_mode: int. Mode for regular files, e.g. 0660 (None to leave unchanged)
+    exclude: full paths of subtrees to skip entirely.
+    workers: number of threads walking subtrees of base.
+    group_writable: bool. Add group write to entries (like chmod g+w).
+    returns: tuple of (entries checked, entries changed).
+
+    The tree is walked once. Entries that already have the requested owner and
+    mode are left alone, and symlinks are never followed: only the link itself
+    is chowned.
+
+    """
+    log = logger.logging.getLogger('pantheon.permtools.tree')
+    add_mode = stat.S_IWGRP if group_writable else 0
+    engine = _PermissionEngine(owner, group, dir_mode, file_mode, exclude,
+                               add_mode=add_mode)
+
+    # Apply to base and its direct files here; subdirectories are queued so
+    # large trees are walked by several workers.
+    engine.apply(base)
+    queue = Queue.Queue()
+    for name in os.listdir(base):
+        path = os.path.join(base, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            queue.put(path)
+        else:
+            engine.apply(path)
+
+    threads = list()
+    for i in range(max(1, min(workers, queue.qsize()))):
+        thread = threading.Thread(target=_worker, args=(queue, engine))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if engine.errors:
+        raise engine.errors[0]
+    log.info('Checked %s entries in %s, changed %s.' % (engine.checked,
+                                                       base,
+                                                       engine.changed))
+    return (engine.checked, engine.changed)
+
+def set_path_permissions(base, paths, owner=None, group=None, dir_mode=None,
+                         file_mode=None, group_writable=False, acl_group=None,
+                         strict=True):
+    """Set ownership, modes and ACLs only on the given paths beneath base.
+    base: full path to the root the paths are relative to.
+    paths: iterable of paths relative to base (e.g. from git diff --name-only).
+    owner: user name to own each entry (None to leave unchanged).
+    group: group name to own each entry (None to leave unchanged).
+    dir_mode: int. Mode for directories (None to leave unchanged).
+    file_mode: int. Mode for regular files (None to leave unchanged).
+    group_writable: bool. Add group write to entries (like chmod g+w).
+    acl_group: group to grant rwx through ACLs (None to leave ACLs unchanged).
+    strict: bool. If False, skip entries we are not permitted to change.
+    returns: tuple of (entries checked, entries changed).
+
+    Parent directories of each path (up to base) are included, as they may
+    have been created by the same update. Paths that no longer exist (e.g.
+    removed by the update) are skipped.
+
+    """
+    log = logger.logging.getLogger('pantheon.permtools.paths')
+    add_mode = stat.S_IWGRP if group_writable else 0
+    engine = _PermissionEngine(owner, group, dir_mode, file_mode,
+                               add_mode=add_mode, strict=strict)
+    base = os.path.abspath(base)
+    entries = set()
+    for path in paths:
+        path = os.path.normpath(os.path.join(base, path))
+        while path.startswith(base + os.sep) and path not in entries:
+            entries.add(path)
+            path = os.path.dirname(path)
+    entries = sorted([e for e in entries if os.path.lexists(e)])
+
+    for entry in entries:
+        engine.apply(entry)
+    if acl_group:
+        set_path_acls(acl_group, entries, strict)
+
+    log.info('Checked %s changed paths in %s, changed %s.' % (engine.checked,
+                                                             base,
+                                                             engine.changed))
+    return (engine.checked, engine.changed)
+
+def set_path_acls(acl_group, paths, strict=True):
+    """Grant acl_group rwx on paths (and as a default ACL on directories).
+    acl_group: group name to grant access.
+    paths: list of full paths. Symlinks are skipped.
+    strict: bool. If False, ignore setfacl failures.
+
+    """
+    paths = [p for p in paths if not os.path.islink(p)]
+    # Batch paths to stay well under the argument length limit.
+    for i in range(0, len(paths), 500):
+        _apply_acls(acl_group, paths[i:i + 500], False, strict)
+
+def set_acl_groupwritability(acl_group, directory, workers=WORKERS):
+    """Grant acl_group rwx on directory and everything beneath it.
+    acl_group: group name to grant access.
+    directory: full path to the root of the tree.
+    workers: number of threads applying ACLs to subtrees in parallel.
+    returns: tuple of (entries checked, entries changed).
+
+    Each entry ends up with exactly the ACL of the former five recursive
+    setfacl passes (remove-all, mask, group, default mask, default group):
+    its base entries, mask::rwx and group:acl_group:rwx, with the same as a
+    default ACL on directories. Each subtree is read with a single
+    'getfacl -R' and only entries whose ACL differs are rewritten, with a
+    single 'setfacl --restore' per subtree.
+
+    """
+    log = logger.logging.getLogger('pantheon.permtools.acl')
+    checked, changed = _apply_acls(acl_group, [directory], False)
+
+    # Spread the top level entries over the workers.
+    entries = [os.path.join(directory, name) for name in os.listdir(directory)]
+    entries = [e for e in entries if not os.path.islink(e)]
+    chunks = [entries[i::workers] for i in range(workers)]
+    results = list()
+    errors = list()
+
+    def apply_chunk(chunk):
+        try:
+            results.append(_apply_acls(acl_group, chunk, True))
+        except Exception, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=apply_chunk, args=(chunk,)) \
+               for chunk in chunks if chunk]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    for result in results:
+        checked += result[0]
+        changed += result[1]
+    log.info('Checked ACLs of %s entries in %s, changed %s.' % (checked,
+                                                               directory,
+                                                               changed))
+    return (checked, changed)
+
+def _apply_acls(acl_group, paths, recursive, strict=True):
+    """Read the ACLs of paths and rewrite those that are not as desired.
+    acl_group: group name to grant access.
+    paths: list of full paths.
+    recursive: bool. Include everything beneath paths.
+    strict: bool. If False, ignore getfacl/setfacl failures.
+    returns: tuple of (entries checked, entries changed).
+
+    """
+    if not paths:
+        return (0, 0)
+    command = ['getfacl', '--physical', '--absolute-names']
+    if recursive:
+        command.append('--recursive')
+    getfacl = subprocess.Popen(command + paths, stdout=subprocess.PIPE)
+    current = getfacl.communicate()[0]
+    if getfacl.returncode != 0 and strict:
+        raise OSError('getfacl exited with status %s' % getfacl.returncode)
+
+    checked = 0
+    restore = list()
+    for name, entries in _parse_getfacl(current):
+        checked += 1
+        is_dir = os.path.isdir(_unescape_acl_name(name))
+        desired = _desired_acl(entries, acl_group, is_dir)
+        if desired is not None and desired != entries:
+            restore.append('# file: %s\n%s\n' % (name,
+                                                  '\n'.join(sorted(desired))))
+    if restore:
+        setfacl = subprocess.Popen(['setfacl', '--restore=-'],
+                                   stdin=subprocess.PIPE)
+        setfacl.communicate('\n'.join(restore))
+        if setfacl.returncode != 0 and strict:
+            raise OSError('setfacl exited with status %s' % setfacl.returncode)
+    return (checked, len(restore))
+
+def _parse_getfacl(output):
+    """Yield (escaped file name, set of ACL entries) from getfacl output.
+
+    """
+    name = None
+    entries = set()
+    for line in output.split('\n') + ['']:
+        line = line.split('#effective:')[0].strip()
+        if not line:
+            if name is not None:
+                yield (name, entries)
+            name = None
+            entries = set()
+        elif line.startswith('# file: '):
+            name = line[len('# file: '):]
+        elif not line.startswith('#'):
+            entries.add(line)
+
+def _desired_acl(entries, acl_group, is_dir):
+    """Return the set of ACL entries an entry should have, keeping its base
+    (owner/group/other) permissions. None if the base entries are unknown.
+
+    """
+    base = [e for e in entries if e.split(':')[0] in ('user', 'group', 'other')
+            and e.split(':')[1] == '']
+    if len(base) != 3:
+        return None
+    acl = set(base)
+    acl.update(['mask::rwx', 'group:%s:rwx' % acl_group])
+    if is_dir:
+        acl.update(['default:' + e for e in acl])
+    return acl
+
+def _unescape_acl_name(name):
+    """Decode the octal escapes getfacl uses in file names.
+
+    """
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), name)
+
+def _worker(queue, engine):
+    """Walk queued subtrees until the queue is empty.
+
+    """
+    while True:
+        try:
+            path = queue.get_nowait()
+        except Queue.Empty:
+            return
+        try:
+            engine.apply_tree(path)
+        except Exception, e:
+            engine.errors.append(e)
+
+
+class _PermissionEngine(object):
+
+    def __init__(self, owner, group, dir_mode, file_mode, exclude=(),
+                 add_mode=0, strict=True):
+        """Initialize the desired ownership and modes.
+        add_mode: mode bits to add to entries without an explicit mode.
+        strict: bool. If False, skip entries we are not permitted to change.
+
+        """
+        self.uid = -1 if owner is None else pwd.getpwnam(owner).pw_uid
+        self.gid = -1 if group is None else grp.getgrnam(group).gr_gid
+        self.dir_mode = dir_mode
+        self.file_mode = file_mode
+        self.exclude = set(exclude)
+        self.add_mode = add_mode
+        self.strict = strict
+        self.checked = 0
+        self.changed = 0
+        self.errors = list()
+        self._lock = threading.Lock()
+
+    def apply_tree(self, base):
+        """Apply permissions to base and all entries beneath it.
+
+        """
+        if base in self.exclude:
+            return
+        self.apply(base)
+        for root, dirs, files in walk(base, topdown=True):
+            for name in list(dirs):
+                path = os.path.join(root, name)
+                if path in self.exclude:
+                    dirs.remove(name)
+                else:
+                    self.apply(path)
+            for name in files:
+                self.apply(os.path.join(root, name))
+
+    def apply(self, path):
+        """Apply ownership and mode to a single entry, if they differ.
+
+        """
+        if path in self.exclude:
+            return
+        try:
+            st = os.lstat(path)
+            changed = False
+            if (self.uid != -1 and st.st_uid != self.uid) or \
+               (self.gid != -1 and st.st_gid != self.gid):
+                os.lchown(path, self.uid, self.gid)
+                changed = True
+            if stat.S_ISDIR(st.st_mode):
+                mode = self.dir_mode
+            elif stat.S_ISREG(st.st_mode):
+                mode = self.file_mode
+            else:
+                mode = None
+            if mode is None and self.add_mode and \
+               not stat.S_ISLNK(st.st_mode):
+                mode = stat.S_IMODE(st.st_mode) | self.add_mode
+            if mode is not None and stat.S_IMODE(st.st_mode) != mode:
+                os.chmod(path, mode)
+                changed = True
+        except OSError, e:
+            # Entries can disappear while we walk (e.g. cache files).
+            if e.errno == errno.ENOENT:
+                return
+            if e.errno == errno.EPERM and not self.strict:
+                return
+            raise
+        with self._lock:
+            self.checked += 1
+            if changed:
+                self.changed += 1
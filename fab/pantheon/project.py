@@ -3,7 +3,10 @@ import tempfile
 
 import dbtools
 import drupaltools
+import filetools
+import gittools
 import pantheon
+import permtools
 import ygg
 from vars import *
 
@@ -33,6 +36,8 @@ class BuildTools(object):
         self.db_password = self.config\
                 ['environments']['live']['mysql']['db_password']
         self.version = None
+        # Databases with Drupal installed. See is_drupal_installed().
+        self._installed_databases = None
 
     def bcfg2_project(self):
         local('bcfg2 -vqedb projects', capture=False)
@@ -47,6 +52,8 @@ class BuildTools(object):
         locations.append(os.path.join('/var/git/projects', self.project))
         # Project webroot
         locations.append(self.project_path)
+        # Caches and queued events
+        locations.append(os.path.join(pantheon.STATE_DIR, self.project))
 
         # TODO: We also need to remove the following:
         # Solr Index
@@ -105,6 +112,9 @@ class BuildTools(object):
         pantheon.copy_template('git.hook.post-receive', post_receive_hook)
         local('chmod +x %s' % post_receive_hook)
 
+        # Created here, so pushes by any group member can queue events.
+        pantheon.get_state_dir(self.project)
+
     def setup_project_branch(self):
         """ Create a branch of the project.
 
@@ -118,9 +128,8 @@ class BuildTools(object):
         working_dir: temp directory for project processing (import/restore)
 
         """
-        local('git clone -l /var/git/projects/%s -b %s %s' % (self.project,
-                                                              self.project,
-                                                              working_dir))
+        gittools.clone_shared('/var/git/projects/%s' % self.project,
+                              working_dir, self.project)
 
     def setup_database(self, environment, password, db_dump=None, onramp=False):
         """ Create a new database based on project_environment, using password.
@@ -136,6 +145,7 @@ class BuildTools(object):
 
         dbtools.create_database(database)
         dbtools.set_database_grants(database, username, password)
+        self._installed_databases = None
         if db_dump:
             dbtools.import_db_dump(db_dump, database)
             if onramp:
@@ -212,13 +222,16 @@ if (file_exists('../pantheon%s.settings.php')) {
         for env in self.environments:
             self.server.create_drupal_cron(self.project, env)
 
-    def setup_environments(self, handler=None, working_dir=None):
+    def setup_environments(self, handler=None, working_dir=None,
+                           files_mode='auto'):
         """ Send code/data/files from processing to destination (dev/test/live)
         All import and restore processing is done in temp directories. Once
         processing is complete, it is pushed out to the final destination.
 
         handler: 'import' or None. If import, complete extra import processing.
         working_dir: If handler is import, also needs full path to working_dir.
+        files_mode: how the files directory is fanned out to each environment.
+                    One of filetools.COPY_MODES.
 
         """
 
@@ -231,20 +244,22 @@ if (file_exists('../pantheon%s.settings.php')) {
         for env in self.environments:
             # Code
             destination = os.path.join(self.project_path, env)
-            local('git clone -l /var/git/projects/%s -b %s %s' % (self.project,
-                                                                 self.project,
-                                                                 destination))
-            # On import setup environment data and files.
+            gittools.clone_shared('/var/git/projects/%s' % self.project,
+                                  destination, self.project)
+            # On import setup environment data.
             if handler == 'import':
                 # Data (already exists in 'dev' - import into other envs)
                 if env != 'dev':
                     dbtools.import_data(self, env, dump_file)
+                    self._installed_databases = None
 
-                # Files
-                source = os.path.join(working_dir, 'sites/default/files')
-                file_dir = os.path.join(self.project_path, env,
-                                                'sites/default')
-                local('rsync -av %s %s' % (source, file_dir))
+        # On import, share the same files tree between all environments.
+        if handler == 'import':
+            source = os.path.join(working_dir, 'sites/default/files')
+            file_dirs = [os.path.join(self.project_path, env,
+                                      'sites/default/files')
+                         for env in sorted(self.environments)]
+            filetools.fanout_tree(source, file_dirs, files_mode)
 
         # Cleanup
         if handler == 'import':
@@ -265,7 +280,92 @@ if (file_exists('../pantheon%s.settings.php')) {
             local('git push')
             local('git push --tags')
 
-    def setup_permissions(self, handler, environment=None):
+    def is_drupal_installed(self, environment):
+        """Return True if the Drupal installation process has been completed.
+        environment: environment name.
+
+        The databases of all environments are checked with one query the first
+        time this is called, and the result is reused until a database is
+        (re)created or imported.
+
+        """
+        if self._installed_databases is None:
+            databases = [pantheon.get_database_vars(self, env)[2] \
+                         for env in self.environments]
+            self._installed_databases = \
+                    dbtools.get_installed_databases(databases)
+        db_name = pantheon.get_database_vars(self, environment)[2]
+        return db_name in self._installed_databases
+
+    def setup_release_permissions(self, release, environment):
+        """Set ownership, group write and ACLs on a whole new release.
+        release: full path to the release directory (before it is activated).
+        environment: environment the release is built for.
+
+        The release is checked out from scratch, so every path (.git
+        included) needs the permissions the environment tree has. The shared
+        files directory is only linked in and is left alone. The settings
+        files get the same owner and mode as in setup_permissions(), so
+        Apache can read them as soon as the release is activated.
+
+        """
+        owner = self._get_owner()
+        site_dir = os.path.join(release, 'sites/default')
+        with cd(release):
+            local('git config core.sharedRepository group')
+        permtools.set_tree_permissions(release,
+                                       owner=owner,
+                                       group=owner,
+                                       group_writable=True,
+                                       exclude=[os.path.join(site_dir, name) \
+                                                for name in ('settings.php',
+                                                     'pantheon.settings.php')])
+        if os.path.exists("/etc/pantheon/ldapgroup"):
+            permtools.set_acl_groupwritability(owner, release)
+        # After the ACLs, as setting them changes the group mode bits.
+        self._setup_settings_permissions(environment, site_dir, owner)
+
+    def _setup_settings_permissions(self, environment, site_dir, owner):
+        """Set owner and mode of settings.php and pantheon.settings.php.
+        environment: environment the site directory belongs to.
+        site_dir: full path to the sites/default directory.
+        owner: group that owns project code.
+
+        """
+        if self.is_drupal_installed(environment):
+            # Drupal installed, Apache does not need to own settings.php
+            settings_perms = '440'
+            settings_owner = owner
+        else:
+            # Drupal is NOT installed. Apache must own settings.php
+            settings_perms = '660'
+            settings_owner = self.server.web_group
+        settings_group = self.server.web_group
+
+        with cd(site_dir):
+            # settings.php
+            local('chmod %s settings.php' % settings_perms)
+            local('chown %s:%s settings.php' % (settings_owner,
+                                                settings_group))
+            # TODO: New sites will not have a pantheon.settings.php in their
+            # repos. However, existing backups will, and if the settings
+            # file exists, we need it to have correct permissions.
+            if os.path.exists(os.path.join(site_dir,
+                                           'pantheon.settings.php')):
+                local('chmod 440 pantheon.settings.php')
+                local('chown %s:%s pantheon.settings.php' % (owner,
+                                                   settings_group))
+
+    def _get_owner(self):
+        """Return the group that owns project code (ldap group or web group).
+
+        """
+        #TODO: Allow non-getpantheon users to set a default user.
+        if os.path.exists("/etc/pantheon/ldapgroup"):
+            return self.server.get_ldap_group()
+        return self.server.web_group
+
+    def setup_permissions(self, handler, environment=None, paths=None):
         """ Set permissions on project directory, settings.php, and files dir.
 
         handler: one of: 'import','restore','update','install'. How the
@@ -277,13 +377,12 @@ if (file_exists('../pantheon%s.settings.php')) {
         the update is being run. We do this so we are not forcing permissions
         updates on files that have not changed.
 
+        paths: Only used if handler='update'. Paths (relative to the
+        environment root) touched by the update, e.g. from a git update or a
+        file sync. Ownership, modes and ACLs are fixed on these paths only.
+
         """
-        # Get  owner
-        #TODO: Allow non-getpantheon users to set a default user.
-        if os.path.exists("/etc/pantheon/ldapgroup"):
-            owner = self.server.get_ldap_group()
-        else:
-            owner = self.server.web_group
+        owner = self._get_owner()
 
         # During code updates, we only make changes in one environment.
         # Otherwise, we are modifying all environments.
@@ -307,8 +406,16 @@ if (file_exists('../pantheon%s.settings.php')) {
             for env in environments:
                 with cd(os.path.join(self.server.webroot, self.project, env)):
                     local('git config core.sharedRepository group')
-            with cd(self.server.webroot):
-                local('chown -R %s:%s %s' % (owner, owner, self.project))
+            # Imports/restores set ownership of the files dirs separately.
+            exclude = list()
+            if handler in ['import', 'restore']:
+                exclude = [os.path.join(self.project_path, env,
+                                        'sites/default/files')
+                           for env in environments]
+            permtools.set_tree_permissions(self.project_path,
+                                           owner=owner,
+                                           group=owner,
+                                           exclude=exclude)
 
 
         """
@@ -332,27 +439,43 @@ if (file_exists('../pantheon%s.settings.php')) {
             for env in environments:
                 file_dir = os.path.join(self.project_path, env,
                                         'sites/default/files')
-                with cd(file_dir):
-                    local("chmod 770 .")
-                    # All sub-files
-                    local("find . -type d -exec find '{}' -type f \; | \
-                           while read FILE; do chmod 660 \"$FILE\"; done")
-                    # All sub-directories
-                    local("find . -type d -exec find '{}' -type d \; | \
-                          while read DIR; do chmod 770 \"$DIR\"; done")
-                    # Apache should own files/*
-                    local("chown -R %s:%s ." % (self.server.web_group,
-                                                self.server.web_group))
+                # Apache should own files/*
+                permtools.set_tree_permissions(file_dir,
+                                               owner=self.server.web_group,
+                                               group=self.server.web_group,
+                                               dir_mode=0770,
+                                               file_mode=0660)
 
         # For updates, set apache as owner of files dir.
         elif handler == 'update':
-            site_dir = os.path.join(self.project_path,
-                                    environments[0],
-                                    'sites/default')
+            env_dir = os.path.join(self.project_path, environments[0])
+            site_dir = os.path.join(env_dir, 'sites/default')
             with cd(site_dir):
                 local('chown %s:%s files' % (self.server.web_group,
                                              self.server.web_group))
 
+            # Only touch what the update changed.
+            if paths:
+                files = [p for p in paths \
+                         if p.startswith('sites/default/files/')]
+                code = [p for p in paths \
+                        if not p.startswith('sites/default/files/')]
+                acl_group = None
+                if os.path.exists("/etc/pantheon/ldapgroup"):
+                    acl_group = owner
+                permtools.set_path_permissions(env_dir, code,
+                                               owner=owner,
+                                               group=owner,
+                                               group_writable=True,
+                                               acl_group=acl_group)
+                permtools.set_path_permissions(os.path.join(site_dir, 'files'),
+                                               [p[len('sites/default/files/'):]
+                                                for p in files],
+                                               owner=self.server.web_group,
+                                               group=self.server.web_group,
+                                               dir_mode=0770,
+                                               file_mode=0660)
+
 
         """
         settings.php & pantheon.settings.php
@@ -361,32 +484,10 @@ if (file_exists('../pantheon%s.settings.php')) {
 
         #TODO: We could split this up based on handler, but changing perms on
         # two files is fast. Ignoring for now, and treating all the same.
+        settings_group = self.server.web_group
         for env in environments:
-            if pantheon.is_drupal_installed(self, env):
-                # Drupal installed, Apache does not need to own settings.php
-                settings_perms = '440'
-                settings_owner = owner
-                settings_group = self.server.web_group
-            else:
-                # Drupal is NOT installed. Apache must own settings.php
-                settings_perms = '660'
-                settings_owner = self.server.web_group
-                settings_group = self.server.web_group
-
             site_dir = os.path.join(self.project_path, env, 'sites/default')
-            with cd(site_dir):
-                # settings.php
-                local('chmod %s settings.php' % settings_perms)
-                local('chown %s:%s settings.php' % (settings_owner,
-                                                    settings_group))
-                # TODO: New sites will not have a pantheon.settings.php in their
-                # repos. However, existing backups will, and if the settings
-                # file exists, we need it to have correct permissions.
-                if os.path.exists(os.path.join(site_dir,
-                                               'pantheon.settings.php')):
-                    local('chmod 440 pantheon.settings.php')
-                    local('chown %s:%s pantheon.settings.php' % (owner,
-                                                       settings_group))
+            self._setup_settings_permissions(env, site_dir, owner)
         if not self.version:
             self.version = drupaltools.get_drupal_version('%s/dev' %
                                                           self.project_path)[0]
@@ -1,4 +1,5 @@
 import os
+import urllib2
 
 class RangeableFileObject():
     """File object wrapper to enable raw range handling.
@@ -111,6 +112,96 @@ class RangeableFileObject():
         
         self._do_seek(realoffset - self.realpos)
 
+class HTTPRangeFile():
+    """Read-only, seekable file object over a remote url.
+
+    Data is fetched on demand with HTTP range requests, so readers that only
+    need part of a file (e.g. a zip central directory) never download the
+    rest of it.
+
+    """
+
+    def __init__(self, url, block_size=65536):
+        """Create an HTTPRangeFile.
+
+        url        -- fully qualified url of the remote file.
+        block_size -- minimum number of bytes to request at a time.
+
+        """
+        self.url = url
+        self.block_size = block_size
+        self.pos = 0
+        self.requests = 0
+        self._buffer = ''
+        self._buffer_start = 0
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        response = urllib2.urlopen(request)
+        length = response.info().getheader('Content-Length')
+        response.close()
+        # Without a length (e.g. chunked responses) ranges can't be planned.
+        if length is None or not length.strip().isdigit():
+            raise IOError('No Content-Length reported by %s' % url)
+        self.size = int(length)
+
+    def read(self, size=-1):
+        """Read and return up to size bytes from the current position.
+
+        size -- number of bytes to read. Reads to the end of file if negative.
+
+        """
+        if size is None or size < 0:
+            size = self.size - self.pos
+        end = min(self.pos + size, self.size)
+        if end <= self.pos:
+            return ''
+        buffer_end = self._buffer_start + len(self._buffer)
+        if not (self._buffer_start <= self.pos and end <= buffer_end):
+            fetch_end = min(max(end, self.pos + self.block_size), self.size)
+            self._buffer = self._fetch(self.pos, fetch_end - 1)
+            self._buffer_start = self.pos
+        data = self._buffer[self.pos - self._buffer_start:
+                            end - self._buffer_start]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        """Seek to offset.
+
+        offset -- The byte to seek to
+        whence -- 0: absolute, 1: relative to position, 2: relative to end.
+
+        """
+        assert whence in (0, 1, 2)
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError('Invalid seek offset: %s' % offset)
+        self.pos = offset
+
+    def tell(self):
+        """Return the current position in the remote file."""
+        return self.pos
+
+    def close(self):
+        """Release the read buffer."""
+        self._buffer = ''
+
+    def _fetch(self, firstbyte, lastbyte):
+        """Return bytes firstbyte-lastbyte (inclusive) of the remote file."""
+        request = urllib2.Request(self.url, headers={
+                      'Range': 'bytes=%s-%s' % (firstbyte, lastbyte)})
+        response = urllib2.urlopen(request)
+        self.requests += 1
+        if response.code != 206:
+            response.close()
+            raise IOError('Range requests are not supported by %s' % self.url)
+        data = response.read()
+        response.close()
+        return data
+
 def range_tuple_normalize(range_tup):
     """Normalize a (first_byte,last_byte) range tuple.
     Return a tuple whose first element is guaranteed to be an int
@@ -0,0 +1,228 @@
+import os
+import shutil
+import time
+
+from fabric.api import *
+
+import logger
+
+# Release directories live in <project_path>/releases/<environment>/<id>.
+RELEASE_DIR = 'releases'
+
+# Number of releases kept per environment (including the current one).
+KEEP = 5
+
+# Files carried over from the current release when the new checkout lacks
+# them (e.g. settings files that are written on the server, not committed).
+CARRY_OVER = ('sites/default/settings.php',
+              'sites/default/pantheon.settings.php')
+
+def is_enabled(project_path, environment):
+    """Return True if environment is served from release directories.
+    project_path: full path to the project, e.g. /var/www/<project>
+    environment: environment name.
+
+    An environment uses releases once its directory is a symlink, which is
+    set up by enable().
+
+    """
+    return os.path.islink(os.path.join(project_path, environment))
+
+def enable(project_path, environment):
+    """Convert an environment directory into the first release.
+    project_path: full path to the project.
+    environment: environment name.
+    returns: full path to the release.
+
+    The existing working-tree is moved into place as the first release and
+    its files directory becomes the shared files directory. The environment
+    path is briefly missing between the move and the symlink.
+
+    """
+    log = logger.logging.getLogger('pantheon.releasetools.enable')
+    env_path = os.path.join(project_path, environment)
+    if is_enabled(project_path, environment):
+        return current(project_path, environment)
+
+    base = _base(project_path, environment)
+    if not os.path.exists(base):
+        os.makedirs(base)
+    with cd(env_path):
+        rev = local('git rev-parse HEAD').rstrip('\n')
+    release = os.path.join(base, _release_id(rev))
+    os.rename(env_path, release)
+
+    files = os.path.join(release, 'sites/default/files')
+    shared = shared_files(project_path, environment)
+    if os.path.isdir(files) and not os.path.islink(files):
+        os.rename(files, shared)
+    elif not os.path.exists(shared):
+        os.makedirs(shared)
+    _link_files(release, shared)
+    _link_settings(project_path, environment)
+    activate(project_path, environment, release)
+    log.info('Enabled releases for %s in %s.' % (environment, project_path))
+    return release
+
+def build(project_path, environment, repo, branch, rev):
+    """Build a new release of rev next to the current one.
+    project_path: full path to the project.
+    environment: environment name.
+    repo: full path to the central repository.
+    branch: branch name the working-tree is on.
+    rev: commit sha to check out.
+    returns: full path to the new (not yet active) release.
+
+    The release shares its objects with repo (git clone --shared), so only
+    the working-tree is written. The shared files directory is linked in.
+
+    """
+    log = logger.logging.getLogger('pantheon.releasetools.build')
+    base = _base(project_path, environment)
+    release = os.path.join(base, _release_id(rev))
+    if os.path.exists(release):
+        shutil.rmtree(release)
+    local('git clone --shared --no-checkout %s %s' % (repo, release))
+    with cd(release):
+        local('git checkout -q -B %s %s' % (branch, rev))
+        local('git config branch.%s.remote origin' % branch)
+        local('git config branch.%s.merge refs/heads/%s' % (branch, branch))
+
+    previous = current(project_path, environment)
+    for path in CARRY_OVER:
+        source = os.path.join(previous, path)
+        destination = os.path.join(release, path)
+        if os.path.exists(source) and not os.path.exists(destination):
+            shutil.copy2(source, destination)
+            # Keep the owner, so apache can still read e.g. settings.php.
+            st = os.stat(source)
+            os.chown(destination, st.st_uid, st.st_gid)
+    _link_files(release, shared_files(project_path, environment))
+    _link_settings(project_path, environment)
+    log.info('Built release %s.' % release)
+    return release
+
+def activate(project_path, environment, release):
+    """Atomically point the environment at release.
+
+    A new symlink is created under a temporary name and renamed over the
+    environment path, so requests see either the old or the new release.
+
+    """
+    env_path = os.path.join(project_path, environment)
+    temp = '%s.%s.tmp' % (env_path, os.getpid())
+    if os.path.lexists(temp):
+        os.remove(temp)
+    os.symlink(os.path.relpath(release, os.path.realpath(project_path)), temp)
+    os.rename(temp, env_path)
+
+def rollback(project_path, environment, release=None):
+    """Switch environment back to an earlier release.
+    release: release id to switch to. Defaults to the one before current.
+    returns: full path to the activated release.
+
+    """
+    log = logger.logging.getLogger('pantheon.releasetools.rollback')
+    releases = get_releases(project_path, environment)
+    active = current(project_path, environment)
+    if release:
+        target = os.path.join(_base(project_path, environment), release)
+        if target not in releases:
+            abort('Release %s not found for %s.' % (release, environment))
+    else:
+        older = [r for r in releases if r < active]
+        if not older:
+            abort('No earlier release found for %s.' % environment)
+        target = older[-1]
+    activate(project_path, environment, target)
+    log.info('Rolled %s back to %s.' % (environment, target))
+    return target
+
+def prune(project_path, environment, keep=KEEP):
+    """Remove all but the newest keep releases. The current one is kept.
+
+    """
+    active = current(project_path, environment)
+    releases = get_releases(project_path, environment)
+    for release in releases[:max(0, len(releases) - keep)]:
+        if release != active:
+            shutil.rmtree(release)
+
+def current(project_path, environment):
+    """Return the full path to the active release.
+
+    """
+    return os.path.realpath(os.path.join(project_path, environment))
+
+def get_releases(project_path, environment):
+    """Return full paths to all releases of environment, oldest first.
+
+    """
+    base = _base(project_path, environment)
+    if not os.path.isdir(base):
+        return list()
+    # Skip the shared files directory and linked settings files.
+    return sorted([os.path.join(base, name) for name in os.listdir(base) \
+                   if name != 'files' and \
+                      os.path.isdir(os.path.join(base, name)) and \
+                      not os.path.islink(os.path.join(base, name))])
+
+def shared_files(project_path, environment):
+    """Return the full path to the files directory shared between releases.
+
+    """
+    return os.path.join(_base(project_path, environment), 'files')
+
+def _base(project_path, environment):
+    return os.path.realpath(os.path.join(project_path, RELEASE_DIR,
+                                         environment))
+
+def _release_id(rev):
+    # Sorts chronologically.
+    return '%s-%s' % (time.strftime('%Y%m%d%H%M%S'), rev[:7])
+
+def _link_settings(project_path, environment):
+    """Make the project's pantheonN.settings.php files resolve from releases.
+
+    settings.php includes '../pantheonN.settings.php' relative to the Drupal
+    root. PHP resolves that from the real directory (the release), not the
+    environment symlink, so the files are linked next to the releases.
+
+    """
+    base = _base(project_path, environment)
+    for name in os.listdir(os.path.realpath(project_path)):
+        if name.startswith('pantheon') and name.endswith('.settings.php'):
+            link = os.path.join(base, name)
+            target = os.path.join(os.path.realpath(project_path), name)
+            if os.path.realpath(link) != target:
+                if os.path.lexists(link):
+                    os.remove(link)
+                os.symlink(target, link)
+
+def _link_files(release, shared):
+    """Point release's sites/default/files at the shared files directory.
+
+    Tracked paths in the files directory (e.g. its .gitignore) are marked
+    skip-worktree and the link is excluded, so git does not report the
+    release as modified.
+
+    """
+    files = os.path.join(release, 'sites/default/files')
+    if os.path.islink(files):
+        os.remove(files)
+    elif os.path.isdir(files):
+        shutil.rmtree(files)
+    os.symlink(shared, files)
+    with cd(release):
+        local('git ls-files -z sites/default/files | ' + \
+              'git update-index -z --skip-worktree --stdin')
+    exclude = os.path.join(release, '.git/info/exclude')
+    if not os.path.isdir(os.path.dirname(exclude)):
+        os.makedirs(os.path.dirname(exclude))
+    with open(exclude, 'a+') as f:
+        f.seek(0)
+        lines = f.readlines()
+        if '/sites/default/files\n' not in lines:
+            if lines and not lines[-1].endswith('\n'):
+                f.write('\n')
+            f.write('/sites/default/files\n')
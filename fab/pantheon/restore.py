@@ -2,6 +2,9 @@ import os
 import re
 
 import drupaltools
+import filetools
+import gittools
+import pantheon
 import project
 
 from fabric.api import local
@@ -51,8 +54,15 @@ class RestoreTools(project.BuildTools):
         for env in self.environments:
             if os.path.exists('%s/%s' % (self.destination, env)):
                 local('rm -rf %s/%s' % (self.destination, env))
-            with cd(os.path.join(self.working_dir, self.backup_project)):
-                local('rsync -avz %s %s' % (env, self.destination))
+            # The extracted backup is removed afterwards, so move it if we can.
+            filetools.transfer(os.path.join(self.working_dir,
+                                            self.backup_project, env),
+                               os.path.join(self.destination, env),
+                               move=True)
+            # Borrow objects from this project's (restored) central repo.
+            gittools.set_alternates(os.path.join(self.destination, env),
+                                    '/var/git/projects/%s/objects' % \
+                                    self.project)
             # It's possible that the backup is from a different project.
             # If so: rename branch, set remote, and set merge refs.
             with cd(os.path.join(self.destination, env)):
@@ -73,8 +83,11 @@ class RestoreTools(project.BuildTools):
                                    '%s.git' % self.backup_project)
         if os.path.exists(project_repo):
             local('rm -rf %s' % project_repo)
-        local('rsync -avz %s/ %s/' % (backup_repo, project_repo))
+        filetools.transfer(backup_repo, project_repo, move=True)
         local('chmod -R g+w %s' % project_repo)
+        # Caches and queued events describe the replaced repository.
+        pantheon.clear_state(self.project)
+        pantheon.get_state_dir(self.project)
 
         # Enforce a specific origin remote
         with cd(project_repo):
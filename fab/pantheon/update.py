@@ -9,6 +9,9 @@ import project
 import postback
 import logger
 import drupaltools
+import fileindex
+import gittools
+import releasetools
 
 from fabric.api import *
 
@@ -24,6 +27,8 @@ class Updater(project.BuildTools):
                    'Environment not found in project: {0}'.format(self.project)
             context['environment'] = environment
             self.update_env = environment
+            # Paths changed by code/file updates, for incremental permissions.
+            self.changed_paths = list()
             self.author = 'Jenkins User <jenkins@pantheon>'
             self.env_path = os.path.join(self.project_path, environment)
         self.log = logger.logging.LoggerAdapter(self.log, context)
@@ -46,42 +51,48 @@ class Updater(project.BuildTools):
         # Commit all changes in dev working-tree.
         self.code_commit('Core Update: Automated Commit.')
 
+        # Dry-run the merge in the central repo. Dev was just pushed there.
+        preview = gittools.preview_merge(self._central_repo(),
+                                         'refs/heads/%s' % self.project,
+                                         'refs/heads/master')
+        self.log.info('Merge changes %s paths.' % len(preview['changed']))
+
+        if preview['clean']:
+            pull = 'git pull origin master'
+        else:
+            self.log.error('Merge conflicts in: %s' % \
+                           ', '.join(preview['conflicts']))
+            if keep == 'ours':
+                self.log.info('Merging - keeping local changes on conflict.')
+                pull = 'git pull -s recursive -Xours origin master'
+            elif keep == 'theirs':
+                self.log.info('Merging - keeping upstream changes on ' \
+                              'conflict.')
+                pull = 'git pull -s recursive -Xtheirs origin master'
+            elif keep == 'force':
+                self.log.info('Leaving merge conflicts. Please manually ' \
+                              'resolve.')
+                pull = 'git pull origin master'
+            else:
+                #TODO: How do we want to report this back to user?
+                self.log.info('Merge would fail. Leaving dev unchanged.')
+                conflicts = ['CONFLICT: Merge conflict in %s' % path \
+                             for path in preview['conflicts']]
+                return {'merge':'fail','log':'\n'.join(conflicts)}
+
+        # Apply the chosen strategy once.
         with cd(os.path.join(self.project_path, 'dev')):
             with settings(warn_only=True):
-                # Merge latest pressflow.
-                merge = local('git pull origin master')
+                merge = local(pull)
                 self.log.info(merge)
-
-            # Handle failed merges
             if merge.failed:
                 self.log.error('Merge failed.')
-                if keep == 'ours':
-                    self.log.info('Re-merging - keeping local changes on ' \
-                                  'conflict.')
-                    local('git reset --hard ORIG_HEAD')
-                    merge = local('git pull -s recursive -Xours origin master')
-                    self.log.info(merge)
-                    local('git push')
-                elif keep == 'theirs':
-                    self.log.info('Re-merging - keeping upstream changes on ' \
-                                  'conflict.')
-                    local('git reset --hard ORIG_HEAD')
-                    merge = local('git pull -s recursive -Xtheirs origin ' \
-                                  'master')
-                    self.log.info(merge)
-                    local('git push')
-                elif keep == 'force':
-                    self.log.info('Leaving merge conflicts. Please manually ' \
-                                  'resolve.')
-                else:
-                    #TODO: How do we want to report this back to user?
+                if keep != 'force':
                     self.log.info('Rolling back failed changes.')
                     local('git reset --hard ORIG_HEAD')
-                    return {'merge':'fail','log':merge}
-            # Successful merge.
-            else:
-                local('git push')
-                self.log.info('Merge successful.')
+                return {'merge':'fail','log':merge}
+            local('git push')
+            self.log.info('Merge successful.')
         self.log.info('Core update successful.')
         return {'merge':'success','log':merge}
 
@@ -92,19 +103,25 @@ class Updater(project.BuildTools):
             # Update code in 'dev' (Only used when updating from remote push)
             if self.update_env == 'dev':
                 with cd(self.env_path):
+                    old_rev = local('git rev-parse HEAD').rstrip('\n')
                     local('git pull')
+                    self.changed_paths += gittools.get_changed_paths(old_rev,
+                                                                     'HEAD')
 
             # Update code in 'test' (commit & tag in 'dev', fetch in 'test')
             elif self.update_env == 'test':
                 self.code_commit(message)
-                self._tag_code(tag, message)
-                self._fetch_and_reset(tag)
+                target = self._tag_code(tag, message)
+                self._fetch_and_reset(tag, target)
 
             # Update code in 'live' (get latest tag from 'test', fetch in
             # 'live')
             elif self.update_env == 'live':
-                with cd(os.path.join(self.project_path, 'test')):
-                    tag = local('git describe --tags --abbrev=0').rstrip('\n')
+                head = gittools.read_ref(os.path.join(self.project_path,
+                                                      'test', '.git'), 'HEAD')
+                with cd(self._central_repo()):
+                    tag = local('git describe --tags --abbrev=0 %s' % (
+                                                          head)).rstrip('\n')
                 self._fetch_and_reset(tag)
         except:
             self.log.exception('Code update encountered a fatal error.')
@@ -116,25 +133,65 @@ class Updater(project.BuildTools):
 
     def code_commit(self, message):
         try:
-            with cd(os.path.join(self.project_path, 'dev')):
-                local('git checkout %s' % self.project)
-                local('git add -A .')
-                with settings(warn_only=True):
+            dev_path = os.path.join(self.project_path, 'dev')
+            with cd(dev_path):
+                with settings(hide('warnings'), warn_only=True):
+                    branch = local('git symbolic-ref -q HEAD').rstrip('\n')
+                    # Let git cache untracked directory listings between
+                    # runs (ignored by versions without support).
+                    local('git config core.untrackedCache true')
+                if branch != 'refs/heads/%s' % self.project:
+                    local('git checkout %s' % self.project)
+                paths = gittools.get_modified_paths()
+                if paths:
+                    # Stage only the modified paths, not the whole tree.
+                    gittools.stage_paths(dev_path, paths)
                     local('git commit --author="%s" -m "%s"' % (
                           self.author, message), capture=False)
-                local('git push')
+                else:
+                    self.log.info('No changes to commit in dev.')
+                with settings(hide('warnings'), warn_only=True):
+                    ahead = local('git rev-list --count origin/%s..HEAD' % (
+                                                                 self.project))
+                if paths or ahead.failed or ahead.strip() != '0':
+                    local('git push')
         except:
             self.log.exception('Code commit encountered a fatal error.')
             raise
         else:
             self.log.info('Code commit successful.')
 
+    def enable_releases(self):
+        """Serve this environment from atomically switched release dirs.
+
+        """
+        self.log.info('Enabling release directories.')
+        release = releasetools.enable(self.project_path, self.update_env)
+        self.log.info('Current release: %s' % release)
+
+    def code_rollback(self, release=None):
+        """Switch back to an earlier release (default: the previous one).
+
+        """
+        self.log.info('Initialized code rollback.')
+        try:
+            release = releasetools.rollback(self.project_path,
+                                            self.update_env, release)
+        except:
+            self.log.exception('Code rollback encountered a fatal error.')
+            raise
+        else:
+            self.log.info('Rolled back to %s.' % release)
+        self.log.info('Gracefully restarting apache.')
+        local("apache2ctl -k graceful", capture=False)
+
     def data_update(self, source_env):
         self.log.info('Initialized data sync')
         try:
             tempdir = tempfile.mkdtemp()
             export = dbtools.export_data(self, source_env, tempdir)
             dbtools.import_data(self, self.update_env, export)
+            self._installed_databases = None
             local('rm -rf %s' % tempdir)
         except:
             self.log.exception('Data sync encountered a fatal error.')
@@ -145,12 +202,25 @@ class Updater(project.BuildTools):
     def files_update(self, source_env):
         self.log.info('Initialized file sync')
         try:
-            self.log.info('Attempting Rsync...')
+            self.log.info('Attempting indexed file sync...')
             source = os.path.join(self.project_path,
                                   '%s/sites/default/files' % source_env)
             dest = os.path.join(self.project_path,
-                                '%s/sites/default/' % self.update_env)
-            local('rsync -av --delete %s %s' % (source, dest))
+                                '%s/sites/default/files' % self.update_env)
+            if not os.path.exists(dest):
+                os.makedirs(dest)
+            # Indexes are kept between runs, so only changes are transferred.
+            source_index = fileindex.FileIndex(source,
+                    fileindex.get_index_file(self.project, source_env))
+            dest_index = fileindex.FileIndex(dest,
+                    fileindex.get_index_file(self.project, self.update_env))
+            result = fileindex.sync(source_index, dest_index)
+            self.changed_paths += ['sites/default/files/' + path \
+                                   for path in result['changed']]
+            self.log.info('Transferred %s files (%s bytes), removed %s.' % (
+                                                          result['files'],
+                                                          result['bytes'],
+                                                          result['deleted']))
         except:
             self.log.exception('File sync encountered a fatal error.')
             raise
@@ -205,7 +275,8 @@ class Updater(project.BuildTools):
     def permissions_update(self):
         self.log.info('Initialized permissions update.')
         try:
-            self.setup_permissions('update', self.update_env)
+            self.setup_permissions('update', self.update_env,
+                                   self.changed_paths)
         except Exception as e:
             self.log.exception('Permissions update encountered a fatal error.')
             raise
@@ -223,32 +294,95 @@ class Updater(project.BuildTools):
 
     def test_tag(self, tag):
         try:
-            #test of existing tag
-            with cd(self.env_path):
-                with settings(warn_only=True):
-                    count = local('git tag | grep -c ' + tag)
-                    if count.strip() != "0":
-                        abort('warning: tag ' + tag + ' already exists!')
+            # Exact lookup of the tag ref in the central repo (no git call).
+            if gittools.read_ref(self._central_repo(), 'refs/tags/%s' % tag):
+                abort('warning: tag ' + tag + ' already exists!')
         except:
             self.log.exception('Encountered a fatal error while tagging code.')
             raise
 
     def _tag_code(self, tag, message):
+        """Tag dev's HEAD in the central repository.
+        returns: sha of the tagged commit.
+
+        The tag is created directly in the central repository, where it is
+        published, rather than in dev and pushed. code_commit has already
+        pushed dev's HEAD there.
+
+        """
         try:
-            with cd(os.path.join(self.project_path, 'dev')):
-                local('git checkout %s' % self.project)
-                local('git tag "%s" -m "%s"' % (tag, message), capture=False)
-                local('git push --tags')
+            dev_git = os.path.join(self.project_path, 'dev', '.git')
+            target = gittools.read_ref(dev_git, 'HEAD')
+            with cd(self._central_repo()):
+                local('git tag "%s" -m "%s" %s' % (tag, message, target),
+                      capture=False)
+            return target
         except:
             self.log.exception('Encountered a fatal error while tagging code.')
             raise
 
-    def _fetch_and_reset(self, tag):
+    def _release(self, tag, target):
+        """Deploy target into a new release directory and switch to it.
+
+        """
+        release = releasetools.build(self.project_path, self.update_env,
+                                     self._central_repo(), self.project,
+                                     target)
+        # Permissions are set on the whole release before it goes live.
+        self.setup_release_permissions(release, self.update_env)
+        releasetools.activate(self.project_path, self.update_env, release)
+        releasetools.prune(self.project_path, self.update_env)
+        self.log.info('Released %s (%s) as %s.' % (tag, target, release))
+
+    def _central_repo(self):
+        """Return the full path to the project's central repository.
+
+        """
+        return os.path.join('/var/git/projects', self.project)
+
+    def _fetch_and_reset(self, tag, target=None):
+        """Reset this environment to tag.
+        target: sha of the commit tag points to, if already known.
+
+        """
         try:
-            with cd(os.path.join(self.project_path, self.update_env)):
-                local('git checkout %s' % self.project)
-                local('git fetch -t')
-                local('git reset --hard "%s"' % tag)
+            env_path = os.path.join(self.project_path, self.update_env)
+            git_dir = os.path.join(env_path, '.git')
+            if not target:
+                # Resolve the target once, in the central repository.
+                with cd(self._central_repo()):
+                    with settings(hide('everything'), warn_only=True):
+                        target = local('git rev-parse --verify ' \
+                                       '"refs/tags/%s^{commit}"' % tag)
+                if target.failed:
+                    abort('Tag %s not found.' % tag)
+                target = target.strip()
+            with cd(env_path):
+                with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+                    branch = f.read().strip()
+                if branch != 'ref: refs/heads/%s' % self.project:
+                    local('git checkout %s' % self.project)
+                old_rev = gittools.read_ref(git_dir, 'HEAD')
+                if old_rev == target:
+                    with settings(hide('warnings'), warn_only=True):
+                        dirty = local('git diff-index --quiet HEAD --').failed
+                    if not dirty:
+                        self.log.info('Already at %s (%s).' % (tag, target))
+                        return
+                if releasetools.is_enabled(self.project_path, self.update_env):
+                    self._release(tag, target)
+                    return
+                # Environments sharing the central object store already have
+                # the objects. Others fetch only the tag being deployed.
+                if not os.path.exists(os.path.join(git_dir,
+                                                   'objects/info/alternates')):
+                    local('git fetch origin "refs/tags/%s:refs/tags/%s"' % (
+                                                                    tag, tag))
+                # Only entries that differ between the trees (or whose stat
+                # data no longer matches the index) are rewritten.
+                local('git reset --hard %s' % target)
+                self.changed_paths += gittools.get_changed_paths(old_rev,
+                                                                 target)
         except:
             self.log.exception('Fetch and reset encountered a fatal error.')
             raise
@@ -5,6 +5,7 @@ import tempfile
 
 from fabric.api import *
 from pantheon import pantheon
+from pantheon import permtools
 from pantheon import logger
 from pantheon import ygg
 
@@ -97,9 +98,5 @@ def _ldap_domain_to_ldap(domain):
 
 def set_acl_groupwritability(require_group, directory):
     """Set up ACLs for a directory."""
-    local('setfacl --recursive --remove-all %s' % directory)
-    local('setfacl --recursive --no-mask --modify mask:rwx %s' % directory)
-    local('setfacl --recursive --no-mask --modify group:%s:rwx %s' % (require_group, directory))
-    local('setfacl --recursive --modify default:mask:rwx %s' % directory)
-    local('setfacl --recursive --modify default:group:%s:rwx %s' % (require_group, directory))
+    permtools.set_acl_groupwritability(require_group, directory)
 
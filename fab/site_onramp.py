@@ -1,13 +1,19 @@
+from fabric.api import abort
+
+from pantheon import filetools
 from pantheon import onramp
 from pantheon import pantheon
 from pantheon import restore
 from pantheon import status
 from pantheon import logger
 
-def onramp_site(project='pantheon', url=None, profile=None, **kw):
+def onramp_site(project='pantheon', url=None, profile=None, files_mode='auto',
+                **kw):
     """Create a new Drupal installation.
     project: Installation namespace.
     profile: The installation type (e.g. pantheon/openatrium)
+    files_mode: How imported files are shared between the environments.
+                One of filetools.COPY_MODES (auto/reflink/hardlink/copy).
     **kw: Optional dictionary of values to process on installation.
 
     """
@@ -15,13 +21,23 @@ def onramp_site(project='pantheon', url=None, profile=None, **kw):
     log = logger.logging.getLogger('pantheon.onramp.site')
     log = logger.logging.LoggerAdapter(log,
                                        {"project": project})
+    if files_mode not in filetools.COPY_MODES:
+        abort('Invalid files_mode: %s. Use one of: %s.' % (
+              files_mode, ', '.join(filetools.COPY_MODES)))
+    # Reject archives that cannot be imported before downloading them.
+    # Compressed tars are checked by the import after extraction.
+    if profile != 'restore':
+        report = onramp.inspect_archive(url)
+        if report and not profile:
+            profile = report['profile']
+
     archive = onramp.download(url)
     location = onramp.extract(archive)
     handler = _get_handler(profile, project, location)
 
     log.info('Initiated site build.')
     try:
-        handler.build(location)
+        handler.build(location, files_mode)
     except:
         log.exception('Site build encountered an exception.')
         raise
@@ -53,7 +69,7 @@ class _ImportProfile(onramp.ImportTools):
     """Generic Pantheon Import Profile.
 
     """
-    def build(self, location):
+    def build(self, location, files_mode='auto'):
 
         self.build_location = location
         # Parse the extracted archive.
@@ -87,7 +103,7 @@ class _ImportProfile(onramp.ImportTools):
         self.enable_pantheon_settings()
 
         # Clone project to all environments
-        self.setup_environments()
+        self.setup_environments(files_mode)
 
         # Set permissions on project.
         self.setup_permissions()
@@ -105,7 +121,8 @@ class _RestoreProfile(restore.RestoreTools):
     """Generic Pantheon Restore Profile.
 
     """
-    def build(self, location):
+    def build(self, location, files_mode='auto'):
+        # files_mode is unused: restores don't share files between environments.
 
         # Parse the backup.
         self.parse_backup(location)
@@ -96,6 +96,8 @@ def update_pantheon(postback=True):
                 local('git reset --hard origin/%s' % MERCURY_BRANCH, capture=False)
             # Run bcfg2.
             local('/usr/sbin/bcfg2 -vqed', capture=False)
+            # Projects created before state directories existed.
+            pantheon.setup_state_dirs()
         except:
             log.exception('Pantheon update encountered a fatal error.')
             raise
@@ -194,6 +196,26 @@ def update_code(project, environment, tag=None, message=None, taskid=None):
     status.git_repo_status(project)
     status.drupal_update_status(project)
 
+def enable_releases(project, environment):
+    """Deploy code for project/environment into atomic release directories.
+
+    """
+    updater = update.Updater(environment)
+    updater.enable_releases()
+    updater.permissions_update()
+
+def rollback_code(project, environment, release=None, taskid=None):
+    """Switch project/environment back to an earlier release.
+    release: release directory name. Defaults to the previous release.
+
+    """
+    updater = update.Updater(environment)
+    updater.code_rollback(release)
+
+    # Send back repo status and drupal update status
+    status.git_repo_status(project)
+    status.drupal_update_status(project)
+
 def rebuild_environment(project, environment):
     """Rebuild the project/environment with files and data from 'live'.
 
@@ -215,6 +237,7 @@ def update_files(project, environment, source_env, taskid=None):
     """
     updater = update.Updater(environment)
     updater.files_update(source_env)
+    updater.permissions_update()
 
 def git_diff(project, environment, revision_1, revision_2=None):
     """Return git diff